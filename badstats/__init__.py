@@ -9,12 +9,63 @@ def create_app(test_config=None):
 
     # create and configure the app
     app = Flask(__name__, instance_relative_config=True)
-    database = os.path.join(app.instance_path, 'badstats.sqlite')
     app.config.from_mapping(
         SECRET_KEY=os.environ["FLASK_SECRET"],
-        DATABASE=database,
+        DATABASE=os.path.join(app.instance_path, 'badstats.sqlite'),
         SESSION_COOKIE_SECURE=True,
-        SESSION_COOKIE_SAMESITE='Strict'
+        SESSION_COOKIE_SAMESITE='Strict',
+        # Keep-alive connections pooled per Spotify host, should match the
+        # number of waitress threads (4 by default)
+        SPOTIFY_POOL_SIZE=4,
+        # Seconds before the client token expires that it gets replaced
+        CLIENT_TOKEN_REFRESH_MARGIN=60,
+        # Memory for cached catalog responses, 0 turns the cache off
+        SPOTIFY_CACHE_BYTES=32 * 1024 * 1024,
+        # Have identical requests to spotify in flight at once share one response
+        SPOTIFY_COALESCE=True,
+        # Milliseconds to wait on a locked database before giving up
+        DATABASE_BUSY_TIMEOUT=5000,
+        DATABASE_WAL=True,
+        # 'signed' csrf tokens are checked without the database, 'database'
+        # stores each one in the csrf table
+        CSRF_MODE='signed',
+        CSRF_MAX_AGE=120,
+        # Seconds between janitor runs, 0 turns it off
+        JANITOR_INTERVAL=600,
+        JANITOR_BATCH_SIZE=500,
+        JANITOR_BATCH_PAUSE=0.05,
+        # Seconds the tracks of a playlist are kept after its version was stored
+        PLAYLIST_SNAPSHOT_MAX_AGE=7 * 24 * 60 * 60,
+        # Rendered plots, the folder defaults to plots/ in the instance folder
+        PLOT_CACHE_FOLDER=None,
+        PLOT_CACHE_MEMORY_BYTES=16 * 1024 * 1024,
+        PLOT_CACHE_DISK_BYTES=256 * 1024 * 1024,
+        PLOT_CACHE_TTL=24 * 60 * 60,
+        # Render every other kind of plot in the background once one has
+        # been, which keeps a render worker busy for seconds so it's only
+        # worth it with spare workers, and how many albums or playlists to
+        # keep the plotted values of
+        PLOT_BUNDLE=False,
+        PLOT_TABLE_ENTRIES=64,
+        # Plots of more tracks than this summarize their distribution instead
+        # of drawing a bar per track
+        PLOT_AGGREGATE_OVER=150,
+        # Image formats to offer in the order they're preferred, the dpi
+        # raster images are rendered at unless a request asks for another, and
+        # the only dpis they're rendered at (others round to the nearest one).
+        # Browsers accept svg as readily as webp, but svg plots of many tracks
+        # are several times larger, so it's only sent to clients that prefer it
+        PLOT_FORMATS=('webp', 'png', 'svg'),
+        PLOT_DPI=100,
+        PLOT_DPIS=(72, 100, 150),
+        # Worker processes that render plots (0 renders on the request
+        # thread), how many jobs they take at once and seconds per job
+        RENDER_PROCESSES=1,
+        RENDER_QUEUE_SIZE=4,
+        RENDER_TIMEOUT=20,
+        # Warm up plotting, the client token and the render workers at
+        # startup, /ready reports 503 until it's done
+        WARMUP=os.environ.get('BADSTATS_WARMUP', '') == '1',
     )
 
     if test_config is None:
@@ -30,12 +81,23 @@ def create_app(test_config=None):
     except OSError:
         pass
 
+    from spotify.WebAPI import WebAPI
+    WebAPI.configure(app.config['SPOTIFY_POOL_SIZE'])
+
     from . import db
-    if not os.path.exists(database):
-        with app.app_context():
-            db.init_db()
+    with app.app_context():
+        db.migrate_db()
     db.init_app(app)
 
+    from . import janitor
+    janitor.init_app(app)
+
+    from . import render
+    render.init_app(app)
+
+    from . import warmup
+    warmup.init_app(app)
+
     from . import auth
     app.register_blueprint(auth.bp)
 
@@ -1,7 +1,9 @@
-import functools, os, requests, logging
+import functools, os, requests, logging, sqlite3
 from secrets import token_urlsafe
 from datetime import datetime, timedelta
 
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+
 from flask import (
     Blueprint, flash, g, redirect, render_template, request, session, url_for, current_app
 )
@@ -15,7 +17,34 @@ bp = Blueprint('auth', __name__, url_prefix='/auth')
 
 # log = logging.getLogger('badstats')
 
+def _csrfSerializer():
+    return URLSafeTimedSerializer(current_app.config['SECRET_KEY'], salt='badstats-csrf')
+
+def _useNonce(nonce):
+    """Record a signed token's nonce as used, returns False if it already was."""
+
+    # Kept in the database so a token used on one replica can't be used on another
+    db = get_db()
+    try:
+        db.execute(
+            'INSERT INTO csrf_used (nonce, used) VALUES (?, ?)',
+            (nonce, datetime.utcnow().isoformat())
+        )
+    except sqlite3.IntegrityError:
+        db.rollback()
+        return False
+
+    db.commit()
+    return True
+
+def _nonceUsed(nonce):
+    return get_db().execute('SELECT 1 FROM csrf_used WHERE nonce = ?', (nonce,)).fetchone() is not None
+
 def issueCsrf():
+    # Signed tokens carry their own timestamp so they don't need the database
+    if current_app.config['CSRF_MODE'] == 'signed':
+        return _csrfSerializer().dumps(token_urlsafe(16))
+
     csrf = token_urlsafe()
     db = get_db()
     db.execute(
@@ -25,14 +54,18 @@ def issueCsrf():
     db.commit()
     return csrf
 
-def isValid(csrf):
+def isValid(csrf, consume=False):
     # Return True if csrf is valid
     # Return False if not
+    # A consumed token is never valid again
     
     # Return false if no csrf given
     if not csrf:
         return False
 
+    if current_app.config['CSRF_MODE'] == 'signed':
+        return isValidSigned(csrf, consume)
+
     # Check if a matching csrf token is in the database
     db = get_db()
     token = db.execute("SELECT * FROM csrf WHERE token = ?", (csrf,)).fetchone()
@@ -43,7 +76,7 @@ def isValid(csrf):
     # Otherwise a token was found that matches
 
     # Determine when the csrf token expires
-    tokenexpires = datetime.fromisoformat(token["created"]) + timedelta(minutes=2) 
+    tokenexpires = datetime.fromisoformat(token["created"]) + timedelta(seconds=current_app.config["CSRF_MAX_AGE"])
 
     # If it's past it's expiration date, delete form database and return False
     if datetime.utcnow() >= tokenexpires:
@@ -51,9 +84,28 @@ def isValid(csrf):
         db.commit()
         print("CSRF token expired, deleted token")
         return False
+
+    if consume:
+        db.execute('DELETE FROM csrf WHERE token = ?', (csrf,))
+        db.commit()
     
     return True
 
+def isValidSigned(csrf, consume=False):
+    # Check the signature and age of the token without the database,
+    # then make sure the nonce in it hasn't been used already
+    maxAge = current_app.config['CSRF_MAX_AGE']
+
+    try:
+        nonce = _csrfSerializer().loads(csrf, max_age=maxAge)
+    except BadSignature:
+        return False
+
+    if consume:
+        return _useNonce(nonce)
+
+    return not _nonceUsed(nonce)
+
 @bp.route('/spotify/authorize/<kind>', methods=['POST', 'GET'])
 def userAuth(kind):
 
@@ -118,7 +170,7 @@ def receiveAuth(kind):
     # Redirect with the spotify api code to the route to actually
     # Use the authenticated instance of spotify
     state = request.args['state']
-    if isValid(state):
+    if isValid(state, consume=True):
         session['id'] = token_urlsafe()
         session['created'] = datetime.utcnow().isoformat()
 
@@ -1,17 +1,46 @@
-import sqlite3
+import os, sqlite3, threading
 
 import click
 from flask import current_app, g
 from flask.cli import with_appcontext
 
 
+def _connections():
+    """Per-thread connections for the current app."""
+
+    connections = current_app.extensions.get('badstats.db')
+    if connections is None:
+        connections = current_app.extensions.setdefault('badstats.db', threading.local())
+
+    return connections
+
+
+def _connect():
+    db = sqlite3.connect(
+        current_app.config['DATABASE'],
+        detect_types=sqlite3.PARSE_DECLTYPES
+    )
+    db.row_factory = sqlite3.Row
+
+    # Wait on locks held by other threads and replicas instead of failing
+    db.execute(f"PRAGMA busy_timeout = {int(current_app.config.get('DATABASE_BUSY_TIMEOUT', 5000))}")
+
+    # Readers don't block on writers (and vice versa) in WAL mode
+    if current_app.config.get('DATABASE_WAL', True):
+        db.execute('PRAGMA journal_mode = WAL')
+        db.execute('PRAGMA synchronous = NORMAL')
+
+    return db
+
+
 def get_db():
     if 'db' not in g:
-        g.db = sqlite3.connect(
-            current_app.config['DATABASE'],
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        g.db.row_factory = sqlite3.Row
+        # Each thread keeps its connection open between app contexts
+        connections = _connections()
+        if getattr(connections, 'db', None) is None:
+            connections.db = _connect()
+
+        g.db = connections.db
 
     return g.db
 
@@ -20,7 +49,15 @@ def close_db(e=None):
     db = g.pop('db', None)
 
     if db is not None:
-        db.close()
+        # Leave the connection clean for the next request on this thread
+        db.rollback()
+
+def _migrations():
+    """Return the migration scripts in the order they have to be applied."""
+
+    folder = os.path.join(current_app.root_path, 'migrations')
+
+    return sorted(name for name in os.listdir(folder) if name.endswith('.sql'))
 
 def init_db():
     db = get_db()
@@ -28,6 +65,34 @@ def init_db():
     with current_app.open_resource('schema.sql') as f:
         db.executescript(f.read().decode('utf8'))
 
+    # schema.sql already includes every migration
+    db.execute(f'PRAGMA user_version = {len(_migrations())}')
+    db.commit()
+
+def migrate_db():
+    """
+    Apply the migrations a database made by an older schema.sql is missing,
+    a new database is initialized instead.
+    """
+
+    db = get_db()
+
+    if db.execute("SELECT name FROM sqlite_master WHERE name='token'").fetchone() is None:
+        init_db()
+        return 0
+
+    version = db.execute('PRAGMA user_version').fetchone()[0]
+
+    migrations = _migrations()
+    for number, name in enumerate(migrations[version:], start=version + 1):
+        with current_app.open_resource(os.path.join('migrations', name)) as f:
+            db.executescript(f.read().decode('utf8'))
+
+        db.execute(f'PRAGMA user_version = {number}')
+        db.commit()
+
+    return len(migrations) - version
+
 
 @click.command('init-db')
 @with_appcontext
@@ -36,6 +101,14 @@ def init_db_command():
     init_db()
     click.echo('Initialized the database.')
 
+@click.command('migrate-db')
+@with_appcontext
+def migrate_db_command():
+    """Bring an existing database up to date with the current schema."""
+    applied = migrate_db()
+    click.echo(f'Applied {applied} migration(s).')
+
 def init_app(app):
     app.teardown_appcontext(close_db)
-    app.cli.add_command(init_db_command)
\ No newline at end of file
+    app.cli.add_command(init_db_command)
+    app.cli.add_command(migrate_db_command)
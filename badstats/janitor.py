@@ -0,0 +1,100 @@
+import threading, time
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from badstats.db import get_db
+
+def _deleteBatched(db, table, where, params, batchSize, pause):
+    """
+    Delete matching rows batchSize at a time, committing and pausing
+    between batches so other requests can get at the database.
+    """
+
+    deleted = 0
+    while True:
+        cursor = db.execute(
+            f'DELETE FROM {table} WHERE rowid IN'
+            f' (SELECT rowid FROM {table} WHERE {where} LIMIT ?)',
+            (*params, batchSize)
+        )
+        db.commit()
+
+        deleted += cursor.rowcount
+        if cursor.rowcount < batchSize:
+            return deleted
+
+        time.sleep(pause)
+
+def prune(batchSize=None, pause=None):
+    """Remove expired csrf, used csrf nonce, token, lease and playlist snapshot rows. Returns how many rows were deleted per table."""
+
+    config = current_app.config
+    batchSize = batchSize or config['JANITOR_BATCH_SIZE']
+    pause = config['JANITOR_BATCH_PAUSE'] if pause is None else pause
+
+    db = get_db()
+    now = datetime.utcnow()
+    csrfExpired = (now - timedelta(seconds=config['CSRF_MAX_AGE'])).isoformat()
+    snapshotExpired = (now - timedelta(seconds=config['PLAYLIST_SNAPSHOT_MAX_AGE'])).isoformat()
+
+    deleted = {
+        'csrf': _deleteBatched(db, 'csrf', 'created < ?', (csrfExpired,), batchSize, pause),
+        # A nonce only has to be remembered while its token would still be accepted
+        'csrf_used': _deleteBatched(db, 'csrf_used', 'used < ?', (csrfExpired,), batchSize, pause),
+        # User sessions last 30 minutes but their tokens an hour, so once a
+        # user token has expired nobody can use it anymore
+        'token': _deleteBatched(db, 'token', 'expires < ?', (now.isoformat(),), batchSize, pause),
+        'lease': _deleteBatched(db, 'lease', 'expires < ?', (now.isoformat(),), batchSize, pause),
+        'playlist_snapshot': _deleteBatched(
+            db, 'playlist_snapshot', 'updated < ?', (snapshotExpired,), batchSize, pause
+        ),
+    }
+
+    # Give the pages freed by the deletes back to the filesystem
+    db.execute('PRAGMA incremental_vacuum')
+    db.commit()
+
+    return deleted
+
+class Janitor:
+    """Prunes the database every interval seconds on a background thread."""
+
+    def __init__(self, app, interval):
+        self._app = app
+        self._interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="badstats-janitor", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            try:
+                with self._app.app_context():
+                    deleted = prune()
+                self._app.logger.debug(f"Janitor pruned {deleted}")
+            except Exception:
+                self._app.logger.exception("Janitor failed to prune the database")
+
+@click.command('prune-db')
+@with_appcontext
+def prune_db_command():
+    """Delete expired csrf and token rows and vacuum the freed pages."""
+    deleted = prune()
+    click.echo(', '.join(f'{count} {table}' for table, count in deleted.items()) + ' rows deleted.')
+
+def init_app(app):
+    app.cli.add_command(prune_db_command)
+
+    interval = app.config['JANITOR_INTERVAL']
+    if interval and not app.testing:
+        janitor = Janitor(app, interval)
+        app.extensions['badstats.janitor'] = janitor
+        janitor.start()
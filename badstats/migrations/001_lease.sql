@@ -0,0 +1,6 @@
+-- Locks shared by every replica, see spotify.Lease
+CREATE TABLE IF NOT EXISTS lease (
+  name TEXT PRIMARY KEY,
+  holder TEXT NOT NULL,
+  expires TEXT NOT NULL
+);
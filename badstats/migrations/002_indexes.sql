@@ -0,0 +1,4 @@
+-- Every request looks tokens up by session or type and csrf tokens by value
+CREATE INDEX IF NOT EXISTS token_sessionid ON token (sessionid);
+CREATE INDEX IF NOT EXISTS token_type_expires ON token (token_type, expires);
+CREATE INDEX IF NOT EXISTS csrf_token ON csrf (token);
@@ -0,0 +1,6 @@
+-- The janitor prunes csrf rows by age and gives freed pages back to the
+-- filesystem with incremental_vacuum, which needs auto_vacuum set first
+CREATE INDEX IF NOT EXISTS csrf_created ON csrf (created);
+
+PRAGMA auto_vacuum = INCREMENTAL;
+VACUUM;
@@ -0,0 +1,17 @@
+-- Audio features never change for a track, so they are kept for everyone
+CREATE TABLE IF NOT EXISTS audio_features (
+  id TEXT PRIMARY KEY,
+  danceability REAL,
+  energy REAL,
+  key INTEGER,
+  loudness REAL,
+  mode INTEGER,
+  speechiness REAL,
+  acousticness REAL,
+  instrumentalness REAL,
+  liveness REAL,
+  valence REAL,
+  tempo REAL,
+  duration_ms INTEGER,
+  time_signature INTEGER
+) WITHOUT ROWID;
@@ -0,0 +1,11 @@
+-- The tracks of the last version of each playlist that was looked at, see
+-- spotify.Snapshots
+CREATE TABLE IF NOT EXISTS playlist_snapshot (
+  id TEXT PRIMARY KEY,
+  snapshot_id TEXT NOT NULL,
+  name TEXT,
+  tracks BLOB NOT NULL,
+  updated TEXT NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS playlist_snapshot_updated ON playlist_snapshot (updated);
@@ -0,0 +1,8 @@
+-- Nonces of signed csrf tokens that were used, shared by every replica so a
+-- token used on one can't be used again on another, see badstats.auth
+CREATE TABLE IF NOT EXISTS csrf_used (
+  nonce TEXT PRIMARY KEY,
+  used TEXT NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS csrf_used_used ON csrf_used (used);
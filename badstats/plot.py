@@ -1,27 +1,165 @@
+from matplotlib import rcParams, rc_context
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib.figure import Figure
 from io import BytesIO
-import base64
+from PIL import Image
+import threading
+import numpy as np
+
+from spotify.TrackTable import TrackTable
+
+# Formats plots can be rendered in
+FORMATS = ('svg', 'webp', 'png')
 
 def album(kind, tracks):
-    album = tracks['album']
 
-    tracks = tracks['tracks']
-    labels = [x['name'] for x in tracks]
+    return bars(kind, tracks['tracks'], tracks['album'])
 
-    values = [track[f'{kind}'] for track in tracks]
+def playlist(kind, tracks, playlist):
 
-    plot = BarPlot(labels, values, kind, album)
+    return bars(kind, tracks, playlist)
 
-    return plot.render()
+def _table(tracks):
+    if isinstance(tracks, TrackTable):
+        return tracks
+    return TrackTable.fromTracks(tracks)
 
-def playlist(kind, tracks, playlist):
+def bars(kind, tracks, title, aggregateOver=None, format='png', dpi=None):
+    """
+    Render a bar per track, or once there are more than aggregateOver tracks
+    a summary of their distribution that's the same size however many there are.
+    tracks is a TrackTable or a list of tracks.
+    """
+
+    # Tracks without audio features can't be plotted for those kinds
+    labels, values = _table(tracks).present(kind)
+
+    if aggregateOver is not None and len(values) > aggregateOver:
+        plot = DistributionPlot(values, kind, title)
+    else:
+        plot = BarPlot(labels, values, kind, title)
+
+    return plot.render(format, dpi)
+
+def bundle(kinds, tracks, title, aggregateOver=None, format='png', dpi=None):
+    """Render the bar plot of every kind from the same tracks, returns a dict of kind to image."""
+
+    tracks = _table(tracks)
 
-    labels = [track['name'] for track in tracks]
-    values = [track[f'{kind}'] for track in tracks]
+    return {kind: bars(kind, tracks, title, aggregateOver, format, dpi) for kind in kinds}
 
-    plot = BarPlot(labels, values, kind, playlist)
+def smallMultiples(kinds, tracks, title, aggregateOver=None, format='png', dpi=None):
+    """Render every kind as a small plot in one figure, histograms if there are more than aggregateOver tracks."""
 
-    return plot.render()
+    tracks = _table(tracks)
+    plot = SmallMultiplesPlot(kinds, tracks, title, aggregate=aggregateOver is not None and len(tracks) > aggregateOver)
+
+    return plot.render(format, dpi)
+
+class FigurePool:
+    """
+    Figures kept by each thread to draw plots on again, so every render
+    doesn't allocate a new figure, canvas and pixel buffer.
+
+    A figure is cleared when it's acquired and goes back to the pool once
+    it's rendered. Each thread keeps at most maxFigures, and drops the pixel
+    buffers of those it keeps once they add up to more than maxPixels.
+    """
+
+    def __init__(self, maxFigures=2, maxPixels=4_000_000):
+        self._maxFigures = maxFigures
+        self._maxPixels = maxPixels
+        self._local = threading.local()
+
+        self._lock = threading.Lock()
+        self._stats = {'created': 0, 'reused': 0, 'buffers_dropped': 0}
+
+    def _free(self):
+        free = getattr(self._local, 'free', None)
+        if free is None:
+            free = self._local.free = []
+        return free
+
+    def acquire(self, figsize=None):
+        """Return a blank figure of figsize inches, the default size if None."""
+
+        free = self._free()
+        if free:
+            figure = free.pop()
+            figure.clear()
+            self._count('reused')
+        else:
+            figure = Figure()
+            # Keep the agg canvas, savefig would otherwise make a new one each time
+            FigureCanvasAgg(figure)
+            self._count('created')
+
+        figure.set_size_inches(figsize or rcParams['figure.figsize'])
+
+        return figure
+
+    def release(self, figure):
+        """Give a figure back to the pool once it's no longer used."""
+
+        free = self._free()
+        if len(free) >= self._maxFigures:
+            return
+
+        # A new canvas doesn't hold on to the last one's pixel buffer
+        retained = sum(self._pixels(other) for other in free)
+        if retained + self._pixels(figure) > self._maxPixels:
+            FigureCanvasAgg(figure)
+            self._count('buffers_dropped')
+
+        free.append(figure)
+
+    def render(self, figure, format='png', dpi=None):
+        """Return figure as an image in format at dpi, the figure's own if None, and release it."""
+
+        figfile = BytesIO() # Where to save figure
+
+        try:
+            # savefig would use the dpi the figure was created with
+            dpi = dpi or rcParams['figure.dpi']
+            figure.set_dpi(dpi)
+
+            if format == 'svg':
+                # Text as text rather than outlines of every glyph, and the
+                # same ids and no date so the same plot gives the same bytes
+                with rc_context({'svg.fonttype': 'none', 'svg.hashsalt': 'badstats'}):
+                    figure.savefig(figfile, format='svg', metadata={'Date': None})
+            elif format == 'webp':
+                figure.savefig(figfile, format='webp', dpi=dpi, pil_kwargs={'lossless': True})
+            elif format == 'png':
+                # Plots use few colors, a palette makes the file a fraction of the size
+                figure.canvas.draw()
+                image = Image.fromarray(np.asarray(figure.canvas.buffer_rgba())).convert('RGB')
+                image.quantize(256).save(figfile, format='png', optimize=True)
+            else:
+                raise Exception(f"Can't render plots as {format}.")
+        finally:
+            figure.set_dpi(rcParams['figure.dpi'])
+            self.release(figure)
+
+        return figfile.getvalue()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def _count(self, stat):
+        with self._lock:
+            self._stats[stat] += 1
+
+    @staticmethod
+    def _pixels(figure):
+        renderer = getattr(figure.canvas, 'renderer', None)
+        if renderer is None:
+            return 0
+        return renderer.width * renderer.height
+
+# Figures reused by renders on this process' threads
+figures = FigurePool()
 
 class BarPlot:
 
@@ -35,7 +173,7 @@ class BarPlot:
         if len(labels) != len(values):
             raise Exception("Different number of labels and values in plot.")
 
-        self._figure = Figure()
+        self._figure = figures.acquire()
         self._axis = self._figure.subplots()
         
         self._labels = labels
@@ -49,7 +187,7 @@ class BarPlot:
         
     def _addBarstoChartAxis(self):
 
-        labelPositions = [(self._barWidth * i) for i in range(len(self._labels))]
+        labelPositions = self._barWidth * np.arange(len(self._labels))
         
         self._createBars(
             labelPositions,
@@ -65,7 +203,7 @@ class BarPlot:
         else:
             self._axis.set_title(f'{self._kind.capitalize()}')
 
-        self._setTicks([((self._labelWidth/2) + (x * self._barWidth)) for x in range(len(self._labels))])
+        self._setTicks((self._labelWidth/2) + self._barWidth * np.arange(len(self._labels)))
         self._setLabels(self._labels, rotation=self._labelOrientation)
 
         self._figure.tight_layout()
@@ -106,11 +244,114 @@ class BarPlot:
             self._setLabels = self._axis.set_xticklabels
             self._setTicks = self._axis.set_xticks
 
-    def render(self):
-        figfile = BytesIO() # Where to save figure
+    def render(self, format='png', dpi=None):
+
+        return figures.render(self._figure, format, dpi)
+
+class SmallMultiplesPlot:
+    """A grid with one small bar plot per kind, tracks in the same order in each."""
+
+    _columns = 3
+    _cellWidth = 4
+    _cellHeight = 2.5
+
+    def __init__(self, kinds: list, tracks: TrackTable, title: str=None, aggregate: bool=False):
+
+        rows = -(-len(kinds) // self._columns)
+
+        self._figure = figures.acquire((self._columns * self._cellWidth, rows * self._cellHeight))
+        axes = self._figure.subplots(rows, self._columns, squeeze=False).flatten()
+
+        for axis, kind in zip(axes, kinds):
+            values = tracks.column(kind)
+            positions = np.flatnonzero(~np.isnan(values))
+
+            if aggregate:
+                axis.hist(values[positions], bins=DistributionPlot._bins)
+            else:
+                axis.bar(positions, values[positions])
+                axis.set_xticks([])
+            axis.set_title(kind.capitalize())
+
+        # Hide the cells left over in the last row
+        for axis in axes[len(kinds):]:
+            axis.set_visible(False)
+
+        if title:
+            self._figure.suptitle(f'"{title}"')
+
+        self._figure.tight_layout()
+
+    def render(self, format='png', dpi=None):
+
+        return figures.render(self._figure, format, dpi)
+
+class DistributionPlot:
+    """
+    Many tracks summarized in a figure of fixed size: a histogram of the
+    values with their quartiles marked, next to the values in playlist order
+    as a rolling mean over bands of percentiles.
+    """
+
+    _bins = 30
+
+    # Points drawn along the playlist, whatever its length
+    _segments = 100
+
+    def __init__(self, values: list, kind: str, title: str=None):
+
+        values = np.asarray(values, dtype=float)
+
+        self._figure = figures.acquire((10, 4.8))
+        self._histogram, self._order = self._figure.subplots(1, 2)
+
+        self._addHistogram(values)
+        self._addOrder(values)
+
+        name = kind.capitalize()
+        self._histogram.set_xlabel(name)
+        self._histogram.set_ylabel('Tracks')
+        self._order.set_xlabel('Track')
+        self._order.set_ylabel(name)
+
+        if title:
+            self._figure.suptitle(f'"{title}" {name} ({len(values)} tracks)')
+        else:
+            self._figure.suptitle(f'{name} ({len(values)} tracks)')
+
+        self._figure.tight_layout()
+
+    def _addHistogram(self, values):
+
+        counts, edges = np.histogram(values, bins=self._bins)
+        self._histogram.stairs(counts, edges, fill=True)
+
+        for quartile, style in zip(np.percentile(values, [25, 50, 75]), (':', '-', ':')):
+            self._histogram.axvline(quartile, color='black', linestyle=style)
+
+    def _addOrder(self, values):
+
+        # Split the playlist into segments and summarize each one
+        bounds = np.linspace(0, len(values), min(self._segments, len(values)) + 1).astype(int)
+        segments = [values[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+        positions = (bounds[:-1] + bounds[1:]) / 2
+
+        low, lower, upper, high = np.array([
+            np.percentile(segment, [10, 25, 75, 90]) for segment in segments
+        ]).T
+
+        self._order.fill_between(positions, low, high, color='C0', alpha=0.2, label='10th to 90th percentile')
+        self._order.fill_between(positions, lower, upper, color='C0', alpha=0.4, label='25th to 75th percentile')
+
+        # Rolling mean over a window as wide as a segment
+        window = bounds[1] - bounds[0]
+        sums = np.cumsum(np.insert(values, 0, 0))
+        means = (sums[window:] - sums[:-window]) / window
+        sampled = np.linspace(0, len(means) - 1, min(len(means), self._segments * 2)).astype(int)
+
+        self._order.plot(sampled + window / 2, means[sampled], color='black', label='Rolling mean')
+        self._order.legend(fontsize='small')
 
-        self._figure.savefig(figfile, format='png') # Save the current figure
-        figfile.seek(0)  # rewind to beginning of file
-        figdata_png = base64.b64encode(figfile.getvalue()) # Base64 encode figure
+    def render(self, format='png', dpi=None):
 
-        return figdata_png
\ No newline at end of file
+        return figures.render(self._figure, format, dpi)
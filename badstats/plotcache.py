@@ -0,0 +1,227 @@
+import hashlib, json, os, threading, time
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timezone
+
+from flask import current_app
+
+# A rendered image with what's needed to answer conditional requests
+RenderedPlot = namedtuple('RenderedPlot', ['data', 'etag', 'modified'])
+
+class RenderCache:
+    """
+    Rendered plots kept in a least recently used cache in memory, backed by
+    files in a folder on disk that every replica sharing it can read.
+
+    Both tiers are capped in bytes and entries expire ttl seconds after they
+    were rendered. When the disk tier grows past its cap the oldest files
+    are removed first.
+    """
+
+    def __init__(self, folder, memoryBytes, diskBytes, ttl):
+        self._folder = folder
+        self._memoryBytes = memoryBytes
+        self._diskBytes = diskBytes
+        self._ttl = ttl
+
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._memoryUsed = 0
+        self._diskUsed = None
+
+        self._stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0}
+
+        # Images rendered and their total bytes by format
+        self._formats = {}
+
+        os.makedirs(folder, exist_ok=True)
+
+    @staticmethod
+    def key(*parts):
+        """Build a cache key from what identifies the plot, e.g. ('album', id, kind, params)."""
+
+        return hashlib.sha256(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self._folder, f'{key}.img')
+
+    def get(self, key):
+        """Return the RenderedPlot for key, or None if it isn't cached or has expired."""
+
+        now = time.time()
+
+        with self._lock:
+            plot = self._memory.get(key)
+            if plot is not None and now - plot.modified.timestamp() < self._ttl:
+                self._memory.move_to_end(key)
+                self._stats['memory_hits'] += 1
+                return plot
+
+        try:
+            path = self._path(key)
+            modified = os.path.getmtime(path)
+            if now - modified >= self._ttl:
+                raise FileNotFoundError(path)
+
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            with self._lock:
+                self._stats['misses'] += 1
+            return None
+
+        plot = self._plot(data, modified)
+        with self._lock:
+            self._stats['disk_hits'] += 1
+            self._remember(key, plot)
+
+        return plot
+
+    def put(self, key, data, format=None):
+        """Cache the rendered image data under key and return it as a RenderedPlot."""
+
+        plot = self._plot(data, time.time())
+
+        with self._lock:
+            self._remember(key, plot)
+
+            if format is not None:
+                rendered = self._formats.setdefault(format, {'images': 0, 'bytes': 0})
+                rendered['images'] += 1
+                rendered['bytes'] += len(data)
+
+        # Write to a temporary file first so readers never see half an image
+        path = self._path(key)
+        temporary = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temporary, 'wb') as f:
+            f.write(data)
+        os.replace(temporary, path)
+
+        with self._lock:
+            if self._diskUsed is not None:
+                self._diskUsed += len(data)
+            overCap = self._diskUsed is None or self._diskUsed > self._diskBytes
+
+        if overCap:
+            self._evictDisk()
+
+        return plot
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                self._stats,
+                memory_bytes=self._memoryUsed,
+                disk_bytes=self._diskUsed,
+                formats={format: dict(rendered) for format, rendered in self._formats.items()},
+            )
+
+    @staticmethod
+    def _plot(data, modified):
+        return RenderedPlot(
+            data,
+            hashlib.sha1(data).hexdigest(),
+            datetime.fromtimestamp(int(modified), timezone.utc)
+        )
+
+    def _remember(self, key, plot):
+        """Add a plot to the memory tier, the lock must be held."""
+
+        if len(plot.data) > self._memoryBytes:
+            return
+
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memoryUsed -= len(previous.data)
+
+        self._memory[key] = plot
+        self._memoryUsed += len(plot.data)
+
+        while self._memoryUsed > self._memoryBytes:
+            key, evicted = self._memory.popitem(last=False)
+            self._memoryUsed -= len(evicted.data)
+            self._stats['evictions'] += 1
+
+    def _evictDisk(self):
+        """Recount the disk tier and remove the oldest files until it's under its cap."""
+
+        files = []
+        with os.scandir(self._folder) as entries:
+            for entry in entries:
+                if entry.name.endswith('.img'):
+                    try:
+                        info = entry.stat()
+                    except OSError:
+                        continue
+                    files.append((info.st_mtime, info.st_size, entry.path))
+
+        used = sum(size for modified, size, path in files)
+        evicted = 0
+
+        for modified, size, path in sorted(files):
+            if used <= self._diskBytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            used -= size
+            evicted += 1
+
+        with self._lock:
+            self._diskUsed = used
+            self._stats['evictions'] += evicted
+
+class TrackTableCache:
+    """
+    The tracks of recently plotted albums and playlists, reduced to the
+    values plots need, so plotting another kind doesn't fetch them again.
+    """
+
+    def __init__(self, maxEntries):
+        self._lock = threading.Lock()
+        self._tables = OrderedDict()
+        self._maxEntries = maxEntries
+
+    def get(self, key, load):
+        """Return the table cached under key, calling load() for it on a miss."""
+
+        with self._lock:
+            table = self._tables.get(key)
+            if table is not None:
+                self._tables.move_to_end(key)
+                return table
+
+        table = load()
+
+        with self._lock:
+            self._tables[key] = table
+            while len(self._tables) > self._maxEntries:
+                self._tables.popitem(last=False)
+
+        return table
+
+def get_render_cache():
+    """Return the RenderCache shared by the app."""
+
+    cache = current_app.extensions.get('badstats.render_cache')
+    if cache is None:
+        config = current_app.config
+        cache = current_app.extensions.setdefault('badstats.render_cache', RenderCache(
+            config['PLOT_CACHE_FOLDER'] or os.path.join(current_app.instance_path, 'plots'),
+            config['PLOT_CACHE_MEMORY_BYTES'],
+            config['PLOT_CACHE_DISK_BYTES'],
+            config['PLOT_CACHE_TTL'],
+        ))
+
+    return cache
+
+def get_track_tables():
+    """Return the TrackTableCache shared by the app."""
+
+    tables = current_app.extensions.get('badstats.track_tables')
+    if tables is None:
+        tables = current_app.extensions.setdefault(
+            'badstats.track_tables', TrackTableCache(current_app.config['PLOT_TABLE_ENTRIES'])
+        )
+
+    return tables
@@ -0,0 +1,191 @@
+import multiprocessing, threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from flask import current_app
+
+def _renderJob(name, args):
+    """Runs in a worker process, where the plotting code is imported on first use."""
+
+    from badstats import plot
+
+    return getattr(plot, name)(*args)
+
+def warmUpRendering():
+    """Import matplotlib and draw a figure once so the first real plot is fast."""
+
+    from badstats import plot
+
+    plot.playlist('energy', [{'name': 'warm up', 'energy': 1}], 'warm up')
+
+class RenderService:
+    """
+    Renders plots in a small pool of worker processes so matplotlib doesn't
+    hold the GIL on the server's request threads.
+
+    At most queueSize jobs are in the pool at once and each gets timeout
+    seconds. Jobs are rendered inline on the calling thread instead when the
+    pool is off (processes=0), full or broken. A job that is too slow is
+    left to finish in the pool rather than rendered a second time.
+    """
+
+    def __init__(self, processes, queueSize, timeout, logger=None):
+        self._processes = processes
+        self._timeout = timeout
+        self._logger = logger
+        self._slots = threading.BoundedSemaphore(queueSize)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._warming = []
+
+        self._stats = {'pool': 0, 'inline': 0, 'background': 0, 'timeouts': 0, 'failures': 0}
+
+    def start(self):
+        """Start the worker processes and have each one warm up."""
+
+        if not self._processes:
+            return
+
+        with self._lock:
+            if self._executor is None:
+                # Forking a threaded server isn't safe, start clean interpreters instead
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self._processes,
+                    mp_context=multiprocessing.get_context('spawn'),
+                )
+                self._warming = [
+                    self._executor.submit(warmUpRendering) for i in range(self._processes)
+                ]
+
+    def waitUntilWarm(self, timeout=None):
+        """Block until the workers started by start() have warmed up, returns False on timeout."""
+
+        with self._lock:
+            warming = list(self._warming)
+
+        done, pending = wait(warming, timeout=timeout)
+
+        return not pending
+
+    def stop(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def render(self, name, *args, done=None):
+        """
+        Return the result of badstats.plot.<name>(*args), or None if the pool
+        didn't finish it in time. The job keeps running then, and done(result)
+        is called once it does.
+        """
+
+        executor = self._executor
+        future = self._submit(executor, name, args)
+        if future is None:
+            return self._inline(name, args)
+
+        try:
+            result = future.result(timeout=self._timeout)
+        except TimeoutError:
+            # A running job can't be cancelled, let its result be used when it's done
+            self._count('timeouts')
+            self._warn(f"Rendering {name} in the pool timed out, leaving it to finish")
+            if done is not None:
+                future.add_done_callback(lambda future: self._finished(future, done))
+            return None
+        except BrokenProcessPool:
+            self._count('failures')
+            self._restart(executor)
+            self._warn(f"Render pool broke while rendering {name}, rendering inline")
+            return self._inline(name, args)
+
+        self._count('pool')
+        return result
+
+    def background(self, name, *args, done):
+        """
+        Render badstats.plot.<name>(*args) in the pool without waiting for
+        it, done(result) is called once it's finished. Nothing is rendered
+        and False is returned if the pool is off or full, so requests never
+        wait on work nobody asked for yet.
+        """
+
+        future = self._submit(self._executor, name, args)
+        if future is None:
+            return False
+
+        future.add_done_callback(lambda future: self._finished(future, done))
+        self._count('background')
+
+        return True
+
+    def _submit(self, executor, name, args):
+        """Start a job in the pool, returns None if it's off, full or broken."""
+
+        if executor is None or not self._slots.acquire(blocking=False):
+            return None
+
+        try:
+            future = executor.submit(_renderJob, name, args)
+        except (BrokenProcessPool, RuntimeError):
+            self._slots.release()
+            self._restart(executor)
+            return None
+
+        # The slot is freed once the worker is done, even if we stop waiting
+        future.add_done_callback(lambda future: self._slots.release())
+
+        return future
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def _finished(self, future, done):
+        if future.cancelled() or future.exception() is not None:
+            return
+
+        done(future.result())
+
+    def _inline(self, name, args):
+        self._count('inline')
+        return _renderJob(name, args)
+
+    def _restart(self, broken):
+        """Replace a broken pool, unless another thread already did."""
+
+        with self._lock:
+            if self._executor is not broken:
+                return
+            self._executor = None
+
+        broken.shutdown(wait=False, cancel_futures=True)
+        self.start()
+
+    def _count(self, stat):
+        with self._lock:
+            self._stats[stat] += 1
+
+    def _warn(self, message):
+        if self._logger is not None:
+            self._logger.warning(message)
+
+def get_render_service():
+    """Return the RenderService shared by the app."""
+
+    return current_app.extensions['badstats.render']
+
+def init_app(app):
+    config = app.config
+
+    # Tests render inline rather than starting processes for every app
+    service = RenderService(
+        0 if app.testing else config['RENDER_PROCESSES'],
+        config['RENDER_QUEUE_SIZE'],
+        config['RENDER_TIMEOUT'],
+        app.logger,
+    )
+    app.extensions['badstats.render'] = service
+    service.start()
@@ -2,7 +2,13 @@ DROP TABLE IF EXISTS user;
 DROP TABLE IF EXISTS post;
 DROP TABLE IF EXISTS token;
 DROP TABLE IF EXISTS csrf;
+DROP TABLE IF EXISTS lease;
+DROP TABLE IF EXISTS audio_features;
+DROP TABLE IF EXISTS playlist_snapshot;
+DROP TABLE IF EXISTS csrf_used;
 
+-- Keep this file in step with the migrations folder, init_db marks a fresh
+-- database as having every migration applied.
 
 -- CREATE TABLE user (
 --   id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -32,4 +38,59 @@ CREATE TABLE csrf (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
   token TEXT NOT NULL,
   created INTEGER NOT NULL
-);
\ No newline at end of file
+);
+
+CREATE INDEX token_sessionid ON token (sessionid);
+CREATE INDEX token_type_expires ON token (token_type, expires);
+CREATE INDEX csrf_token ON csrf (token);
+CREATE INDEX csrf_created ON csrf (created);
+
+-- Locks shared by every replica, see spotify.Lease
+CREATE TABLE lease (
+  name TEXT PRIMARY KEY,
+  holder TEXT NOT NULL,
+  expires TEXT NOT NULL
+);
+
+-- Audio features never change for a track, so they are kept for everyone
+CREATE TABLE audio_features (
+  id TEXT PRIMARY KEY,
+  danceability REAL,
+  energy REAL,
+  key INTEGER,
+  loudness REAL,
+  mode INTEGER,
+  speechiness REAL,
+  acousticness REAL,
+  instrumentalness REAL,
+  liveness REAL,
+  valence REAL,
+  tempo REAL,
+  duration_ms INTEGER,
+  time_signature INTEGER
+) WITHOUT ROWID;
+
+-- The tracks of the last version of each playlist that was looked at, see
+-- spotify.Snapshots
+CREATE TABLE playlist_snapshot (
+  id TEXT PRIMARY KEY,
+  snapshot_id TEXT NOT NULL,
+  name TEXT,
+  tracks BLOB NOT NULL,
+  updated TEXT NOT NULL
+);
+
+CREATE INDEX playlist_snapshot_updated ON playlist_snapshot (updated);
+
+-- Nonces of signed csrf tokens that were used, shared by every replica so a
+-- token used on one can't be used again on another, see badstats.auth
+CREATE TABLE csrf_used (
+  nonce TEXT PRIMARY KEY,
+  used TEXT NOT NULL
+);
+
+CREATE INDEX csrf_used_used ON csrf_used (used);
+
+-- Lets the janitor return freed pages with incremental_vacuum
+PRAGMA auto_vacuum = INCREMENTAL;
+VACUUM;
@@ -1,19 +1,204 @@
 from flask import (
-    Blueprint, render_template, request, redirect, url_for, g, current_app, session
+    Blueprint, render_template, request, redirect, url_for, g, current_app, session, jsonify
 )
 from flask.wrappers import Response
 from werkzeug.exceptions import abort
-import logging
+import hashlib, itertools, json, logging
 from datetime import datetime, timedelta
 from badstats.db import get_db
 
 from spotify.Spotify import Spotify, UserSpotify
+from spotify.AsyncSpotify import AsyncSpotify
+from spotify.Snapshots import PlaylistSnapshots
 from badstats import getHostname
-import badstats.plot as plot
 from badstats.auth import withValidSession
+from badstats.plotcache import get_render_cache, get_track_tables
+from badstats.render import get_render_service
 
 bp = Blueprint('stats', __name__)
 
+# Track values that can be plotted
+PLOT_KINDS = (
+    'popularity', 'danceability', 'duration_ms', 'energy', 'loudness', 'speechiness',
+    'acousticness', 'instrumentalness', 'liveness', 'valence', 'tempo',
+)
+
+# Seconds browsers (and for albums, proxies) may reuse a plot image
+ALBUM_PLOT_MAX_AGE = 60 * 60
+PLAYLIST_PLOT_MAX_AGE = 5 * 60
+
+# Seconds to tell clients to wait for a plot still rendering after the timeout
+PLOT_RETRY_AFTER = 5
+
+# Plots every kind at once in a grid
+ALL_KINDS = 'all'
+
+# Most playlists that can be compared at once
+COMPARE_MAX_PLAYLISTS = 5
+
+# Media types of the formats plots can be rendered in
+PLOT_MEDIA_TYPES = {
+    'svg': 'image/svg+xml',
+    'webp': 'image/webp',
+    'png': 'image/png',
+}
+
+def _imageFormat(format=None):
+    """
+    Return the (format, dpi) to render a plot image in. Unless the route
+    fixes the format it comes from ?format= or the Accept header, and is PNG
+    if the client doesn't say. Raster images take their dpi from ?dpi=,
+    rounded to the nearest of a few presets so each one is cached once.
+    """
+
+    config = current_app.config
+
+    format = format or request.args.get('format')
+    if format is None:
+        offered = [PLOT_MEDIA_TYPES[format] for format in config['PLOT_FORMATS']]
+        mediaType = request.accept_mimetypes.best_match(offered) if request.accept_mimetypes else None
+        format = next((format for format, type in PLOT_MEDIA_TYPES.items() if type == mediaType), 'png')
+
+    if format not in PLOT_MEDIA_TYPES:
+        abort(400)
+
+    # Vector images look the same at any dpi
+    if format == 'svg':
+        return format, None
+
+    dpi = request.args.get('dpi', config['PLOT_DPI'], type=int)
+
+    return format, min(config['PLOT_DPIS'], key=lambda preset: abs(preset - dpi))
+
+def _trackTable(item, load):
+    """
+    Return (title, TrackTable) for item, e.g. ('album', id). load() returns
+    them and is only called if the table isn't already cached.
+    """
+
+    return get_track_tables().get(item, load)
+
+def _album(id):
+    """Return the track table item and loader of an album."""
+
+    def load():
+        # Only import numpy once there are tracks to put in a table
+        from spotify.TrackTable import TrackTable
+
+        spotify = AsyncSpotify()
+        tracks = spotify.run(spotify.albumTrackDetails(id))
+        return tracks['album'], TrackTable.fromTracks(tracks['tracks'])
+
+    return ('album', id), load
+
+def _playlist(spotify, id):
+    """
+    Return the track table item and loader of the current version of a
+    playlist. Only a version that hasn't been stored before is fetched.
+    """
+
+    # The snapshot id changes whenever the playlist does
+    snapshotId = spotify.playlistSnapshot(id)['snapshot_id']
+
+    def load():
+        snapshots = PlaylistSnapshots()
+
+        stored = snapshots.get(id, snapshotId)
+        if stored is not None:
+            return stored
+
+        from spotify.TrackTable import TrackTable
+
+        response, ids = spotify.playlistTrackIds(id)
+        details = AsyncSpotify(spotify)
+        table = TrackTable.fromTracks(details.run(details.multipleSongDetails(ids)))
+        snapshots.put(id, snapshotId, response['name'], table)
+
+        return response['name'], table
+
+    return ('playlist', id, snapshotId), load
+
+def _cachedPlot(item, load, kind, format='png', dpi=None):
+    """
+    Return the RenderedPlot of kind for item, e.g. ('album', id), as an
+    image in format at dpi. On a miss the tracks come from _trackTable(item,
+    load), so they're fetched at most once while cached. In bundle mode the
+    other kinds are then rendered in the background, so switching kinds is
+    served from the cache. Returns None if rendering timed out, the plot is
+    cached once the job finishes.
+    """
+
+    cache = get_render_cache()
+
+    def keyFor(kind):
+        return cache.key(*item, kind, format, dpi)
+
+    rendered = cache.get(keyFor(kind))
+    if rendered is not None:
+        return rendered
+
+    title, tracks = _trackTable(item, load)
+    service = get_render_service()
+    aggregateOver = current_app.config['PLOT_AGGREGATE_OVER']
+
+    def putImage(data):
+        return cache.put(keyFor(kind), data, format)
+
+    def putImages(images):
+        for other, data in images.items():
+            cache.put(keyFor(other), data, format)
+
+    if kind == ALL_KINDS:
+        data = service.render('smallMultiples', PLOT_KINDS, tracks, title, aggregateOver, format, dpi, done=putImage)
+        return None if data is None else putImage(data)
+
+    data = service.render('bars', kind, tracks, title, aggregateOver, format, dpi, done=putImage)
+    if data is None:
+        return None
+
+    rendered = putImage(data)
+
+    # The kind asked for goes out first, the others follow in the background
+    if current_app.config['PLOT_BUNDLE']:
+        others = tuple(other for other in PLOT_KINDS if other != kind)
+        service.background('bundle', others, tracks, title, aggregateOver, format, dpi, done=putImages)
+
+    return rendered
+
+def _revalidated(response, etag):
+    """Have the browser keep a private page and check with us if it changed before reusing it."""
+
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+
+    return response
+
+def _imageResponse(rendered, format, maxAge, private=False):
+    """
+    Respond with a rendered plot and caching headers, or with 304 Not
+    Modified if the client already has it. A plot that is still rendering
+    is a 503 telling the client when to try again.
+    """
+
+    if rendered is None:
+        response = Response('Still rendering, try again shortly.', status=503, mimetype='text/plain')
+        response.retry_after = PLOT_RETRY_AFTER
+        return response
+
+    response = Response(rendered.data, mimetype=PLOT_MEDIA_TYPES[format])
+    # The same url gives a different format depending on the Accept header
+    response.vary.add('Accept')
+    response.set_etag(rendered.etag)
+    response.last_modified = rendered.modified
+    response.cache_control.max_age = maxAge
+    if private:
+        response.cache_control.private = True
+    else:
+        response.cache_control.public = True
+
+    return response.make_conditional(request)
+
 @bp.route('/')
 def index():
     return redirect( url_for('stats.search', kind='artist', results=''))
@@ -47,8 +232,9 @@ def item(kind, id):
     if not id:
         return render_template('stats/index.html')
     
-    spotify = Spotify()
-    result = spotify.item(kind, id)
+    # The artist and song pages fetch two things at once
+    spotify = AsyncSpotify()
+    result = spotify.run(spotify.item(kind, id))
 
     if not result:
         abort(500)
@@ -57,11 +243,40 @@ def item(kind, id):
 
 @bp.route('/plot/album/<kind>/<id>')
 def plotPNG(kind, id):
-    spotify = Spotify()
-    tracks = spotify.albumTrackDetails(id)
-    fig_data = plot.album(kind, tracks)
-        
-    return render_template('stats/plot.html', result=fig_data.decode('utf-8'))
+    if kind not in PLOT_KINDS and kind != ALL_KINDS:
+        abort(404)
+
+    return render_template('stats/plot.html', src=url_for('stats.plotImage', kind=kind, id=id))
+
+@bp.route('/plot/album/<kind>/<id>/image')
+@bp.route('/plot/album/<kind>/<id>.png', endpoint='plotImagePNG', defaults={'format': 'png'})
+def plotImage(kind, id, format=None):
+    if kind not in PLOT_KINDS and kind != ALL_KINDS:
+        abort(404)
+
+    format, dpi = _imageFormat(format)
+
+    rendered = _cachedPlot(*_album(id), kind, format, dpi)
+
+    return _imageResponse(rendered, format, ALBUM_PLOT_MAX_AGE)
+
+@bp.route('/summary/album/<id>')
+def albumSummary(id):
+    title, table = _trackTable(*_album(id))
+
+    return render_template(
+        'stats/summary.html',
+        title=title,
+        summary=table.summary(PLOT_KINDS),
+        percentiles=table.percentiles,
+        src=url_for('stats.albumSummaryJSON', id=id),
+    )
+
+@bp.route('/summary/album/<id>.json')
+def albumSummaryJSON(id):
+    title, table = _trackTable(*_album(id))
+
+    return jsonify(dict(table.summary(PLOT_KINDS), name=title))
 
 @bp.route('/user/<kind>')
 @withValidSession
@@ -76,22 +291,119 @@ def userPlaylists(kind):
 @bp.route('/user/<kind>/<id>')
 @withValidSession
 def userItem(kind, id):
+    if kind != "playlist":
+        abort(404)
+
     spotify = UserSpotify(session['id'])
 
-    if kind == "playlist":
-        results = spotify.getPlaylist(id)
+    # The browser's copy of the page is still good if nothing on it changed
+    # Only the body, the headers have a Date that changes on every response
+    details = spotify.playlistDetails(id).json()
+    etag = hashlib.sha1(json.dumps(details, sort_keys=True).encode('utf-8')).hexdigest()
+    if request.if_none_match.contains(etag):
+        return _revalidated(Response(status=304), etag)
 
-    return render_template(f'stats/user/{kind}.html', stats=results)
+    results = spotify.getPlaylist(id)
+
+    return _revalidated(Response(render_template(f'stats/user/{kind}.html', stats=results)), etag)
 
 @bp.route('/user/playlist/<id>/plot/<kind>')
 @withValidSession
 def userPlaylistPlot(id, kind):
+    if kind not in PLOT_KINDS and kind != ALL_KINDS:
+        abort(404)
+
+    src = url_for('stats.userPlaylistImage', id=id, kind=kind)
+
+    return render_template(f'stats/user/playlistPlot.html', src=src)
+
+@bp.route('/user/playlist/<id>/plot/<kind>/image')
+@bp.route('/user/playlist/<id>/plot/<kind>.png', endpoint='userPlaylistImagePNG', defaults={'format': 'png'})
+@withValidSession
+def userPlaylistImage(id, kind, format=None):
+    if kind not in PLOT_KINDS and kind != ALL_KINDS:
+        abort(404)
+
+    format, dpi = _imageFormat(format)
+
     spotify = UserSpotify(session['id'])
 
-    response = spotify.getPlaylist(id)
-    tracks = spotify.multipleSongDetails([track['track']['id'] for track in response['tracks']['items']])
-    
-    fig_data = plot.playlist(kind, tracks, response['name'])
+    rendered = _cachedPlot(*_playlist(spotify, id), kind, format, dpi)
+
+    return _imageResponse(rendered, format, PLAYLIST_PLOT_MAX_AGE, private=True)
+
+@bp.route('/user/playlist/<id>/summary')
+@withValidSession
+def userPlaylistSummary(id):
+    spotify = UserSpotify(session['id'])
+    title, table = _trackTable(*_playlist(spotify, id))
+
+    return render_template(
+        'stats/summary.html',
+        title=title,
+        summary=table.summary(PLOT_KINDS),
+        percentiles=table.percentiles,
+        src=url_for('stats.userPlaylistSummaryJSON', id=id),
+    )
+
+@bp.route('/user/playlist/<id>/summary.json')
+@withValidSession
+def userPlaylistSummaryJSON(id):
+    spotify = UserSpotify(session['id'])
+    title, table = _trackTable(*_playlist(spotify, id))
+
+    return jsonify(dict(table.summary(PLOT_KINDS), name=title))
+
+def _compareIds():
+    """The distinct playlist ids to compare, from ?ids=a,b or ?ids=a&ids=b."""
+
+    ids = [id for value in request.args.getlist('ids') for id in value.split(',') if id]
+    ids = list(dict.fromkeys(ids))
+
+    if not 2 <= len(ids) <= COMPARE_MAX_PLAYLISTS:
+        abort(400)
+
+    return ids
+
+def _comparison(spotify, ids):
+    """Compare every pair of the playlists with ids."""
+
+    from spotify.Similarity import Similarity
+
+    tables = [_trackTable(*_playlist(spotify, id)) for id in ids]
+    similarity = Similarity([table for title, table in tables])
+
+    return {
+        'playlists': [
+            {'id': id, 'name': title, 'tracks': len(table)}
+            for id, (title, table) in zip(ids, tables)
+        ],
+        'pairs': [
+            dict(similarity.compare(a, b), a=ids[a], b=ids[b])
+            for a, b in itertools.combinations(range(len(ids)), 2)
+        ],
+    }
+
+@bp.route('/user/playlist/compare')
+@withValidSession
+def userPlaylistCompare():
+    ids = _compareIds()
+    spotify = UserSpotify(session['id'])
+
+    comparison = _comparison(spotify, ids)
+    names = {playlist['id']: playlist['name'] for playlist in comparison['playlists']}
+
+    return render_template(
+        'stats/user/compare.html',
+        comparison=comparison,
+        names=names,
+        src=url_for('stats.userPlaylistCompareJSON', ids=','.join(ids)),
+    )
+
+@bp.route('/user/playlist/compare.json')
+@withValidSession
+def userPlaylistCompareJSON():
+    ids = _compareIds()
+    spotify = UserSpotify(session['id'])
 
-    return render_template(f'stats/user/playlistPlot.html', result=fig_data.decode('utf-8'))
-    
\ No newline at end of file
+    return jsonify(_comparison(spotify, ids))
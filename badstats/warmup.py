@@ -0,0 +1,82 @@
+import threading
+
+from flask import Blueprint, current_app
+
+from badstats.render import get_render_service, warmUpRendering
+
+bp = Blueprint('health', __name__)
+
+class WarmUp:
+    """
+    Gets a new process up to serving speed on a background thread: loads the
+    client token and waits for the render workers to warm up. Without render
+    workers plots are drawn in this process, so it imports the plotting code
+    and builds the font cache itself instead.
+    """
+
+    def __init__(self, app):
+        self._app = app
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="badstats-warmup", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def isReady(self):
+        return self._ready.is_set()
+
+    def wait(self, timeout=None):
+        return self._ready.wait(timeout)
+
+    def _run(self):
+        app = self._app
+        steps = (
+            ('plotting', self._plotting),
+            ('client token', self._clientToken),
+            ('render workers', self._renderWorkers),
+        )
+
+        # A failed step only means that part stays cold, it isn't fatal
+        for name, step in steps:
+            try:
+                with app.app_context():
+                    step()
+                app.logger.debug(f"Warmed up {name}")
+            except Exception:
+                app.logger.exception(f"Failed to warm up {name}")
+
+        self._ready.set()
+
+    def _plotting(self):
+        # The workers import matplotlib and numpy, keep them out of this
+        # process unless it draws the plots itself
+        if self._app.config['RENDER_PROCESSES']:
+            return
+
+        # Drawing a figure imports them and loads the fonts
+        warmUpRendering()
+
+    @staticmethod
+    def _clientToken():
+        from spotify.Token import BasicCreds
+        BasicCreds()
+
+    def _renderWorkers(self):
+        get_render_service().waitUntilWarm(timeout=self._app.config['RENDER_TIMEOUT'])
+
+@bp.route('/ready')
+def ready():
+    # Only report ready once warm-up is done, if it's turned on
+    warmUp = current_app.extensions.get('badstats.warmup')
+    if warmUp is not None and not warmUp.isReady():
+        return 'warming up', 503
+
+    return 'ready'
+
+def init_app(app):
+    app.register_blueprint(bp)
+
+    if app.config['WARMUP']:
+        warmUp = WarmUp(app)
+        app.extensions['badstats.warmup'] = warmUp
+        warmUp.start()
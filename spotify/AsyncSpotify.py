@@ -0,0 +1,183 @@
+import asyncio, threading
+
+from flask import current_app
+
+from spotify.Spotify import Spotify
+from spotify.WebAPI import WebAPI
+from spotify.Paging import Paging
+from spotify.Features import FeatureStore
+
+class EventLoop:
+    """
+    An asyncio event loop running on a background thread, so synchronous
+    code like Flask views can wait for coroutines run on it.
+
+    The blocking requests the coroutines make run on the WebAPI worker pool,
+    the same one every other concurrent request to spotify uses, so the
+    connection pool's size limits them all together.
+    """
+
+    def __init__(self):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="spotify-async-loop", daemon=True)
+        self._thread.start()
+
+    def run(self, coroutine, timeout=None):
+        """Run coroutine on the loop and wait for its result."""
+
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result(timeout)
+
+    async def call(self, fn, *args):
+        """Run the blocking fn(*args) on the WebAPI worker pool."""
+
+        return await self._loop.run_in_executor(WebAPI.executor(), fn, *args)
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+class AsyncSpotify:
+    """
+    The catalog methods of Spotify as coroutines. Requests that don't depend
+    on each other are sent at the same time, so a page waits about as long as
+    its slowest request rather than all of them added up.
+
+    Requests go through the Spotify instance given (a new one by default), so
+    they share its token, the connection pool and the response cache. Use
+    run() to wait for a method from synchronous code, e.g.
+
+        spotify = AsyncSpotify()
+        album = spotify.run(spotify.albumTrackDetails(id))
+    """
+
+    def __init__(self, spotify=None):
+        self._spotify = spotify or Spotify()
+        self._app = current_app._get_current_object()
+        self._loop = self.eventLoop()
+
+    @staticmethod
+    def eventLoop():
+        """Return the EventLoop shared by the app."""
+
+        loop = current_app.extensions.get('spotify.loop')
+        if loop is None:
+            loop = current_app.extensions.setdefault('spotify.loop', EventLoop())
+
+        return loop
+
+    def run(self, coroutine, timeout=None):
+        """Wait for a coroutine of this class from synchronous code."""
+
+        return self._loop.run(coroutine, timeout)
+
+    async def _call(self, fn, *args):
+        """Run a blocking call of the app's on the worker pool."""
+
+        def inAppContext():
+            with self._app.app_context():
+                return fn(*args)
+
+        return await self._loop.call(inAppContext)
+
+    async def _query(self, url, params=None):
+        return await self._call(self._spotify.query, url, params)
+
+    async def _batch(self, url, key, ids, limit, params=None):
+        """Request ids in chunks of at most limit ids at once, the results are in the same order as ids."""
+
+        chunks = await asyncio.gather(*(
+            self._query(url, dict(params or {}, ids=",".join(ids[i:i + limit])))
+            for i in range(0, len(ids), limit)
+        ))
+
+        return [result for chunk in chunks for result in chunk[key]]
+
+    async def search(self, query, kind):
+
+        return await self._call(self._spotify.search, query, kind)
+
+    async def item(self, kind, id):
+
+        response, *extra = await asyncio.gather(*(
+            self._query(url, params) for url, params in Spotify.itemQueries(kind, id)
+        ))
+
+        for other in extra:
+            response.update(other)
+
+        return response
+
+    # The resource several items of a kind are fetched from and how many ids it takes at once
+    _itemsResources = {
+        "artist": ("artists", 50),
+        "album": ("albums", 20),
+        "song": ("tracks", 50),
+    }
+
+    async def multipleItems(self, kind, ids):
+
+        resource, limit = self._itemsResources[kind]
+        url = f'https://api.spotify.com/v1/{resource}'
+
+        return await self._batch(url, resource, list(ids), limit, params={'market': 'US'})
+
+    async def multipleSongDetails(self, ids):
+
+        ids = list(ids)
+
+        # Only ask spotify for the audio features nobody has fetched before
+        store = FeatureStore()
+        featuresById = await self._call(store.get, ids)
+        missing = [id for id in dict.fromkeys(ids) if id not in featuresById]
+
+        audioFeatures, tracks = await asyncio.gather(
+            self._batch('https://api.spotify.com/v1/audio-features', 'audio_features', missing, 100),
+            self.multipleItems('song', ids),
+        )
+
+        await self._call(store.add, audioFeatures)
+
+        return _joinFeatures(tracks, featuresById, audioFeatures)
+
+    async def albumTrackDetails(self, id):
+        album = await self.item('album', id)
+        first = album['tracks']
+
+        # Every page after the first can be requested at once
+        urls = Paging.pageUrls(first)
+        if urls is None:
+            # Without an offset and total the next links are followed one by one
+            pages = [first]
+            while 'next' in pages[-1] and pages[-1]['next']:
+                pages.append(await self._query(pages[-1]['next']))
+        else:
+            pages = [first, *await asyncio.gather(*(self._query(url) for url in urls))]
+
+        items = [item for page in pages for item in page['items']]
+
+        def trackSort(item):
+            return item['track_number']
+
+        items = sorted(items, key=trackSort)
+
+        return {
+            'album': album['name'],
+            'tracks': await self.multipleSongDetails([song['id'] for song in items]),
+        }
+
+def _joinFeatures(tracks, featuresById, audioFeatures):
+    """Merge the stored and the newly fetched audio features into their tracks."""
+
+    # Local and unavailable tracks come back as null audio features
+    featuresById.update(
+        (feature['id'], feature) for feature in audioFeatures if feature is not None
+    )
+
+    for track in tracks:
+        if track is None:
+            continue
+
+        feature = featuresById.get(track['id'])
+        if feature is not None:
+            track.update(feature)
+
+    return [track for track in tracks if track is not None]
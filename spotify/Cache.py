@@ -0,0 +1,102 @@
+import re, threading, time
+from collections import OrderedDict
+from urllib.parse import urlsplit, parse_qsl, urlencode
+
+class ResponseCache:
+    """
+    Least recently used cache of responses from the spotify web api.
+
+    Entries expire after a time to live that depends on the endpoint, and the
+    least recently used ones are evicted once the cached bodies add up to
+    more than maxBytes. The raw requests Response is stored so every hit is
+    parsed into fresh objects that callers are free to modify.
+    """
+
+    # Seconds a response stays fresh, the first matching path wins
+    ttls = (
+        (re.compile(r'^/v1/search$'), 60 * 60),
+        (re.compile(r'^/v1/artists/[^/]+/top-tracks$'), 6 * 60 * 60),
+        (re.compile(r'^/v1/audio-features'), 7 * 24 * 60 * 60),
+        (re.compile(r'^/v1/(artists|albums|tracks)'), 24 * 60 * 60),
+    )
+
+    def __init__(self, maxBytes):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._maxBytes = maxBytes
+        self._bytes = 0
+
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    @staticmethod
+    def key(url, params=None):
+        """Normalize a url and its params so equivalent requests share an entry."""
+
+        parts = urlsplit(url)
+        query = parse_qsl(parts.query) + [(key, str(value)) for key, value in (params or {}).items()]
+
+        return (
+            f"{parts.scheme.lower()}://{parts.netloc.lower()}{parts.path.rstrip('/')}"
+            f"?{urlencode(sorted(query))}"
+        )
+
+    @classmethod
+    def ttl(cls, url):
+        """Return how long responses from url can be cached, None if they can't."""
+
+        path = urlsplit(url).path.rstrip('/')
+        for pattern, seconds in cls.ttls:
+            if pattern.match(path):
+                return seconds
+
+        return None
+
+    def get(self, key):
+        """Return the cached response for key, or None."""
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self._misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry[2]
+
+    def put(self, key, url, response):
+        """Cache a response if its endpoint has a time to live and it fits."""
+
+        ttl = self.ttl(url)
+        size = len(response.content)
+        if ttl is None or size > self._maxBytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = (time.monotonic() + ttl, size, response)
+            self._bytes += size
+
+            while self._bytes > self._maxBytes:
+                self._remove(next(iter(self._entries)))
+                self._evictions += 1
+
+    def _remove(self, key):
+        expires, size, response = self._entries.pop(key)
+        self._bytes -= size
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+            }
@@ -0,0 +1,81 @@
+from badstats.db import get_db
+
+class FeatureStore:
+    """
+    Audio features kept in the database by track id.
+
+    Audio features never change for a track, so once any user has fetched
+    them they are served from here to everyone on every replica.
+    """
+
+    columns = (
+        'danceability',
+        'energy',
+        'key',
+        'loudness',
+        'mode',
+        'speechiness',
+        'acousticness',
+        'instrumentalness',
+        'liveness',
+        'valence',
+        'tempo',
+        'duration_ms',
+        'time_signature',
+    )
+
+    # Stay well under SQLite's limit on query parameters
+    _chunkSize = 500
+
+    def get(self, ids):
+        """Return a dict of the stored audio features for ids, ids that aren't stored are left out."""
+
+        ids = list(dict.fromkeys(ids))
+        db = get_db()
+
+        features = {}
+        for i in range(0, len(ids), self._chunkSize):
+            chunk = ids[i:i + self._chunkSize]
+            rows = db.execute(
+                f'SELECT id, {", ".join(self.columns)} FROM audio_features'
+                f' WHERE id IN ({", ".join("?" * len(chunk))})',
+                chunk
+            ).fetchall()
+
+            for row in rows:
+                features[row['id']] = self._toFeature(row)
+
+        return features
+
+    def add(self, features):
+        """Store audio features as returned by the spotify api, nulls are skipped."""
+
+        rows = [
+            (feature['id'], *(feature.get(column) for column in self.columns))
+            for feature in features if feature is not None
+        ]
+        if not rows:
+            return
+
+        db = get_db()
+        db.executemany(
+            f'INSERT OR REPLACE INTO audio_features (id, {", ".join(self.columns)})'
+            f' VALUES ({", ".join("?" * (len(self.columns) + 1))})',
+            rows
+        )
+        db.commit()
+
+    def _toFeature(self, row):
+        """Rebuild the audio features object the spotify api would have sent."""
+
+        id = row['id']
+        feature = {column: row[column] for column in self.columns}
+        feature.update({
+            'id': id,
+            'type': 'audio_features',
+            'uri': f'spotify:track:{id}',
+            'track_href': f'https://api.spotify.com/v1/tracks/{id}',
+            'analysis_url': f'https://api.spotify.com/v1/audio-analysis/{id}',
+        })
+
+        return feature
@@ -0,0 +1,69 @@
+import time
+from datetime import datetime, timedelta
+from secrets import token_urlsafe
+
+from badstats.db import get_db
+
+class Lease:
+    """
+    A named lock kept in the database.
+
+    Every thread and every replica sharing the database sees the same lease,
+    so work guarded by it (like refreshing a token) is done by one caller
+    while the others wait for its result. A lease expires on its own after
+    duration in case its holder dies before releasing it.
+    """
+
+    def __init__(self, name: str, duration=timedelta(seconds=30), interval=0.1):
+        self._name = name
+        self._holder = token_urlsafe()
+        self._duration = duration
+        self._interval = interval
+
+    def acquire(self) -> bool:
+        """Try to take the lease, returns True if it's now held by us."""
+
+        now = datetime.utcnow()
+        db = get_db()
+        cursor = db.execute(
+            'INSERT INTO lease (name, holder, expires) VALUES (?, ?, ?)'
+            ' ON CONFLICT(name) DO UPDATE SET holder=excluded.holder, expires=excluded.expires'
+            ' WHERE lease.expires <= ?',
+            (self._name, self._holder, (now + self._duration).isoformat(), now.isoformat())
+        )
+        db.commit()
+
+        return cursor.rowcount == 1
+
+    def release(self):
+        """Give up the lease if we still hold it."""
+
+        db = get_db()
+        db.execute('DELETE FROM lease WHERE name=? AND holder=?', (self._name, self._holder))
+        db.commit()
+
+    def run(self, fresh, refresh):
+        """
+        Return fresh() if it isn't None, otherwise call refresh() while
+        holding the lease and return its result. Callers that find the lease
+        taken poll fresh() until the holder's result shows up, or until the
+        lease is released or expires and they can take it themselves.
+        """
+
+        while True:
+            result = fresh()
+            if result is not None:
+                return result
+
+            if self.acquire():
+                try:
+                    # The previous holder may have finished right before we took over
+                    result = fresh()
+                    if result is not None:
+                        return result
+
+                    return refresh()
+                finally:
+                    self.release()
+
+            time.sleep(self._interval)
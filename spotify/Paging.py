@@ -0,0 +1,105 @@
+from collections import deque
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+from spotify.WebAPI import WebAPI
+
+class Paging:
+    """
+    Lazily iterates over every item of a spotify paging object.
+
+    Pages are requested as they are needed by following their next links, so
+    only the current page (plus up to `prefetch` pages fetched ahead of it on
+    the WebAPI worker pool) is held in memory.
+    """
+
+    def __init__(self, query, page, prefetch=0):
+        """
+        query is called with a page url and returns the response for it,
+        page is the first paging object, usually nested in another response.
+        """
+
+        self._query = query
+        self._first = page
+        self._prefetch = prefetch
+
+    def __iter__(self):
+        for page in self.pages():
+            yield from page['items']
+
+    def total(self):
+        """The total number of items reported by spotify."""
+
+        return _field(self._first, 'total')
+
+    def pages(self):
+        """Yield each page in order, starting with the first one."""
+
+        if self._prefetch > 0:
+            urls = self.pageUrls(self._first)
+            if urls is not None:
+                return self._prefetchedPages(urls)
+
+        return self._serialPages()
+
+    def _serialPages(self):
+        page = self._first
+
+        while page is not None:
+            yield page
+
+            url = _field(page, 'next')
+            page = self._query(url) if url else None
+
+    def _prefetchedPages(self, urls):
+        urls = iter(urls)
+        pending = deque()
+
+        def fill():
+            while len(pending) < self._prefetch:
+                url = next(urls, None)
+                if url is None:
+                    return
+                pending.append(WebAPI.submit(self._query, url))
+
+        # Start fetching the following pages before the first one is used
+        fill()
+        yield self._first
+
+        while pending:
+            page = pending.popleft().result()
+            fill()
+            yield page
+
+    @staticmethod
+    def pageUrls(page):
+        """
+        Work out the url of every page after this one from its offset, limit
+        and total. Returns None if the paging object doesn't have them.
+        """
+
+        nextUrl = _field(page, 'next')
+        if not nextUrl:
+            return []
+
+        limit = _field(page, 'limit')
+        offset = _field(page, 'offset')
+        total = _field(page, 'total')
+        if limit is None or offset is None or total is None:
+            return None
+
+        parts = urlsplit(nextUrl)
+        params = dict(parse_qsl(parts.query))
+
+        def pageUrl(pageOffset):
+            params.update({'offset': str(pageOffset), 'limit': str(limit)})
+            return urlunsplit(parts._replace(query=urlencode(params)))
+
+        return (pageUrl(start) for start in range(offset + limit, total, limit))
+
+def _field(page, key):
+    """Get a key from either a dict or a WebAPI response, None if it's missing."""
+
+    try:
+        return page[key]
+    except KeyError:
+        return None
@@ -0,0 +1,141 @@
+import numpy as np
+
+class Similarity:
+    """
+    Compares the tracks of two or more TrackTables by their audio features.
+
+    Features are standardized over every track being compared so each one
+    counts the same. For every pair of tables this finds each track's nearest
+    neighbour in the other table and how far apart the distributions of each
+    feature are. Distances between tracks are computed chunkSize rows at a
+    time, so memory stays bounded however long the playlists are.
+    """
+
+    # Audio features tracks are compared by
+    features = (
+        'danceability', 'energy', 'loudness', 'speechiness', 'acousticness',
+        'instrumentalness', 'liveness', 'valence', 'tempo',
+    )
+
+    # Quantiles the distributions of features are compared at
+    _quantiles = np.linspace(0, 1, 101)
+
+    def __init__(self, tables, features=None, chunkSize=1024):
+        if len(tables) < 2:
+            raise Exception("Need at least two tables to compare.")
+
+        self._tables = tables
+        self._features = tuple(features or self.features)
+        self._chunkSize = chunkSize
+
+        # Tracks missing any of the features can't be placed, leave them out
+        self._rows = []
+        self._vectors = []
+        for table in tables:
+            values = np.column_stack([table.column(feature) for feature in self._features])
+            complete = ~np.isnan(values).any(axis=1)
+            self._rows.append(np.flatnonzero(complete))
+            self._vectors.append(values[complete])
+
+        everything = np.concatenate(self._vectors)
+        mean = everything.mean(axis=0) if len(everything) else 0
+        std = everything.std(axis=0) if len(everything) else 1
+        # Features that are the same for every track tell the tracks apart by nothing
+        std = np.where(std > 0, std, 1)
+
+        self._vectors = [(vectors - mean) / std for vectors in self._vectors]
+
+    def nearest(self, a, b):
+        """
+        Return (indices, distances) of the nearest track in table b for each
+        comparable track of table a, as rows of the tables. Tracks of a that
+        have no features get index -1 and a distance of NaN.
+        """
+
+        source, target = self._vectors[a], self._vectors[b]
+
+        indices = np.full(len(self._tables[a]), -1)
+        distances = np.full(len(self._tables[a]), np.nan)
+        if not len(source) or not len(target):
+            return indices, distances
+
+        # |s - t|^2 = |s|^2 + |t|^2 - 2 s.t, a matrix product per chunk of rows
+        targetNorms = np.einsum('ij,ij->i', target, target)
+
+        nearest = np.empty(len(source), dtype=int)
+        squared = np.empty(len(source))
+        for start in range(0, len(source), self._chunkSize):
+            chunk = source[start:start + self._chunkSize]
+
+            chunkDistances = targetNorms - 2 * (chunk @ target.T)
+            chunkDistances += np.einsum('ij,ij->i', chunk, chunk)[:, None]
+
+            best = chunkDistances.argmin(axis=1)
+            nearest[start:start + len(chunk)] = best
+            squared[start:start + len(chunk)] = chunkDistances[np.arange(len(chunk)), best]
+
+        rows = self._rows[a]
+        indices[rows] = self._rows[b][nearest]
+        # Rounding can leave tiny negative squares for identical tracks
+        distances[rows] = np.sqrt(np.maximum(squared, 0))
+
+        return indices, distances
+
+    def distributionDistances(self, a, b):
+        """
+        Return the distance between the distributions of each feature in
+        tables a and b, the 1-Wasserstein (earth mover's) distance between
+        their standardized values approximated at percentiles.
+        """
+
+        source, target = self._vectors[a], self._vectors[b]
+        if not len(source) or not len(target):
+            return {feature: None for feature in self._features}
+
+        distances = np.abs(
+            np.quantile(source, self._quantiles, axis=0) - np.quantile(target, self._quantiles, axis=0)
+        ).mean(axis=0)
+
+        return dict(zip(self._features, distances.tolist()))
+
+    def compare(self, a, b, closest=10):
+        """Summarize how similar tables a and b are, with their closest pairs of tracks."""
+
+        tableA, tableB = self._tables[a], self._tables[b]
+
+        indices, distances = self.nearest(a, b)
+        backDistances = self.nearest(b, a)[1]
+        distributions = self.distributionDistances(a, b)
+
+        matched = np.flatnonzero(indices >= 0)
+        order = matched[np.argsort(distances[matched], kind='stable')[:closest]]
+
+        return {
+            'shared': len(np.intersect1d(tableA.ids.astype(str), tableB.ids.astype(str))),
+            'nearest': {
+                'mean': _mean(distances),
+                'median': _median(distances),
+                'back_mean': _mean(backDistances),
+                'back_median': _median(backDistances),
+            },
+            'distributions': distributions,
+            'distribution': _mean(np.array([
+                np.nan if distance is None else distance for distance in distributions.values()
+            ], dtype=float)),
+            'closest': [
+                {
+                    'track': tableA.names[i],
+                    'match': tableB.names[indices[i]],
+                    'distance': float(distances[i]),
+                }
+                for i in order
+            ],
+        }
+
+def _mean(values):
+    values = values[~np.isnan(values)]
+    return float(values.mean()) if len(values) else None
+
+def _median(values):
+    values = values[~np.isnan(values)]
+    return float(np.median(values)) if len(values) else None
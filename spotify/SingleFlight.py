@@ -0,0 +1,59 @@
+import threading
+from concurrent.futures import Future
+
+class SingleFlight:
+    """
+    Makes concurrent calls for the same key share one call.
+
+    The first caller for a key makes the call, and everyone else asking for
+    that key before it finishes waits for it and gets the same result (or
+    exception). Nothing is kept once the call is done, so a later caller
+    makes a new one.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inFlight = {}
+
+        self._calls = 0
+        self._coalesced = 0
+
+    def do(self, key, fn):
+        """Return fn(), or the result of the call already in flight for key."""
+
+        with self._lock:
+            future = self._inFlight.get(key)
+            leader = future is None
+
+            if leader:
+                future = self._inFlight[key] = Future()
+                self._calls += 1
+            else:
+                self._coalesced += 1
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn()
+        except BaseException as error:
+            self._finish(key)
+            future.set_exception(error)
+            raise
+
+        self._finish(key)
+        future.set_result(result)
+
+        return result
+
+    def _finish(self, key):
+        with self._lock:
+            del self._inFlight[key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'calls': self._calls,
+                'coalesced': self._coalesced,
+                'in_flight': len(self._inFlight),
+            }
@@ -0,0 +1,40 @@
+from datetime import datetime
+
+from badstats.db import get_db
+
+class PlaylistSnapshots:
+    """
+    The TrackTable of the last version of each playlist, kept in the database
+    with the playlist's snapshot id.
+
+    Spotify gives a playlist a new snapshot id whenever it changes, so while
+    the snapshot id is the same the stored tracks can be used instead of
+    fetching every track and its audio features again.
+    """
+
+    def get(self, id, snapshotId):
+        """Return (name, TrackTable) stored for the snapshot of a playlist, or None."""
+
+        row = get_db().execute(
+            'SELECT name, tracks FROM playlist_snapshot WHERE id = ? AND snapshot_id = ?',
+            (id, snapshotId)
+        ).fetchone()
+
+        if row is None:
+            return None
+
+        # Imported here so importing this module doesn't load numpy
+        from spotify.TrackTable import TrackTable
+
+        return row['name'], TrackTable.fromBytes(row['tracks'])
+
+    def put(self, id, snapshotId, name, table):
+        """Store the tracks of a snapshot of a playlist, replacing any older one."""
+
+        db = get_db()
+        db.execute(
+            'INSERT OR REPLACE INTO playlist_snapshot (id, snapshot_id, name, tracks, updated)'
+            ' VALUES (?, ?, ?, ?, ?)',
+            (id, snapshotId, name, table.toBytes(), datetime.utcnow().isoformat())
+        )
+        db.commit()
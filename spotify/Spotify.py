@@ -4,22 +4,96 @@ from spotify.Token import BasicCreds, UserCreds
 from badstats.db import get_db
 
 from spotify.WebAPI import WebAPI
+from spotify.Paging import Paging
+from spotify.Cache import ResponseCache
+from spotify.SingleFlight import SingleFlight
 
 class Spotify:
+
+    # How many pages to request ahead of the one being read
+    pagePrefetch = 1
+
+    # Catalog responses are shared by everyone, user responses are never cached
+    _cache = None
+
+    # Identical requests sent at the same time share one response
+    _inFlight = None
     
     def __init__(self):
         self._token = BasicCreds()
+        self._cache = self.responseCache()
+        self._inFlight = self.singleFlight()
+
+    @staticmethod
+    def responseCache():
+        """Return the ResponseCache shared by the app, None if caching is turned off."""
+
+        maxBytes = current_app.config.get('SPOTIFY_CACHE_BYTES', 0)
+        if not maxBytes:
+            return None
+
+        cache = current_app.extensions.get('spotify.responses')
+        if cache is None:
+            cache = current_app.extensions.setdefault('spotify.responses', ResponseCache(maxBytes))
+
+        return cache
+
+    @staticmethod
+    def singleFlight():
+        """Return the SingleFlight requests share by the app, None if coalescing is turned off."""
+
+        if not current_app.config.get('SPOTIFY_COALESCE', True):
+            return None
+
+        inFlight = current_app.extensions.get('spotify.in_flight')
+        if inFlight is None:
+            inFlight = current_app.extensions.setdefault('spotify.in_flight', SingleFlight())
+
+        return inFlight
+
+    def query(self, url, params=None):
+        """Send a get request to the web api through the response cache and coalescing, if they're on."""
+
+        return self._apiQuery(url, params)
 
     def _apiQuery(self, url, params=None):
+        if self._cache is None:
+            return self._send(url, params)
+
+        key = self._cache.key(url, params)
+        response = self._cache.get(key)
+        if response is not None:
+            return WebAPI(response)
+
+        result = self._send(url, params)
+        self._cache.put(key, url, result.rawResponse())
+
+        return result
+
+    def _send(self, url, params=None):
+        token = self._token.value()
         headers = {
-            'Authorization': f'Bearer {self._token.value()}'
+            'Authorization': f'Bearer {token}'
         }
 
-        return WebAPI.get(
-            url,
-            headers=headers,
-            params=params
-        )
+        if self._inFlight is None:
+            return WebAPI.get(
+                url,
+                headers=headers,
+                params=params
+            )
+
+        # Only requests made with the same token see the same response.
+        # Everyone parses the shared raw response for objects of their own.
+        key = ('GET', ResponseCache.key(url, params), token)
+        response = self._inFlight.do(key, lambda: WebAPI.rawGet(url, headers=headers, params=params))
+
+        return WebAPI(response)
+
+    def _pages(self, page):
+        """Lazily iterate over every item of a paging object."""
+
+        return Paging(self._apiQuery, page, prefetch=self.pagePrefetch)
 
     def search(self, query, kind):
         ## Used to search for artists to inspect
@@ -49,8 +123,10 @@ class Spotify:
         else:
             raise Exception("Invalid search kind after response")
 
-    def item(self, kind, id):
-        
+    @staticmethod
+    def itemQueries(kind, id):
+        """Return the (url, params) of the item and of anything its page shows with it."""
+
         resourceMap = {
             "artist": ("artists", f'https://api.spotify.com/v1/artists/{id}/top-tracks', {'market': 'US'}),
             "album": ("albums", False, None),
@@ -58,68 +134,48 @@ class Spotify:
         }
         resource = resourceMap[kind]
 
-        url = f'https://api.spotify.com/v1/{resource[0]}/{id}'
-        response = self._apiQuery(url)
-
+        queries = [(f'https://api.spotify.com/v1/{resource[0]}/{id}', None)]
         if resource[1]:
-            response.update(self._apiQuery(resource[1], params=resource[2]))
+            queries.append((resource[1], resource[2]))
 
-        return response
+        return queries
 
-    def multipleItems(self, kind, ids):
+    # The methods below send several requests at once, they wait on the
+    # AsyncSpotify methods of the same name so there's one implementation
 
-        resourceMap = {
-            "artist": ("artists", 50),
-            "album": ("albums", 20),
-            "song": ("tracks", 50),
-        }
-        resource = resourceMap[kind]
+    def _concurrently(self):
+        """Return an AsyncSpotify sending its requests through this instance."""
 
-        url = f'https://api.spotify.com/v1/{resource[0]}'
-        params = {
-            'ids': ",".join(ids),
-            'market': 'US',
-        }
-        response = self._apiQuery(url, params=params)[resource[0]]
+        # AsyncSpotify builds on this module
+        from spotify.AsyncSpotify import AsyncSpotify
 
-        return response
-        
-    def multipleSongDetails(self, ids):
+        return AsyncSpotify(self)
 
-        url = f'https://api.spotify.com/v1/audio-features'
-        params = {
-            'ids': ",".join(ids),
-            'market': 'US',
-        }
-        audioFeatures = self._apiQuery(url, params=params)["audio_features"]
+    def item(self, kind, id):
 
-        tracks = self.multipleItems("song", ids)
+        spotify = self._concurrently()
+        return spotify.run(spotify.item(kind, id))
 
-        for track in tracks:
-            for feature in audioFeatures:
-                if track['id'] == feature['id']:
-                    track.update(feature)
+    def multipleItems(self, kind, ids):
 
-        return tracks
+        spotify = self._concurrently()
+        return spotify.run(spotify.multipleItems(kind, ids))
+        
+    def multipleSongDetails(self, ids):
 
-    def albumTrackDetails(self, id):
-        album = self.item('album', id)
+        spotify = self._concurrently()
+        return spotify.run(spotify.multipleSongDetails(ids))
 
-        def trackSort(item):
-            return item['track_number']
+    def albumTrackDetails(self, id):
 
-        album['tracks']['items'].sort(key=trackSort)
-        tracks = {
-            'album': album['name'],
-            'tracks': self.multipleSongDetails([song['id'] for song in album['tracks']['items']])
-            }
-     
-        return tracks
+        spotify = self._concurrently()
+        return spotify.run(spotify.albumTrackDetails(id))
 
 class UserSpotify(Spotify):
 
     def __init__(self, sessionid):
         self._token = UserCreds(sessionid)
+        self._inFlight = self.singleFlight()
     
     @classmethod
     def fromCode(cls, code, url, sessionid):
@@ -132,7 +188,10 @@ class UserSpotify(Spotify):
         
         url = "https://api.spotify.com/v1/me/playlists"
 
-        response = self._apiQuery(url)
+        response = self._apiQuery(url, params={'limit': '50'})
+
+        # Stream the rest of the playlists as they are read
+        response.update({'items': self._pages(dict(response))})
 
         return response
 
@@ -142,4 +201,36 @@ class UserSpotify(Spotify):
 
         response = self._apiQuery(url)
 
-        return response
\ No newline at end of file
+        # Only the first 100 tracks come with the playlist, stream the rest
+        tracks = response['tracks']
+        response.update({'tracks': dict(tracks, items=self._pages(tracks))})
+
+        return response
+
+    def playlistSnapshot(self, id):
+        """Return only the name and snapshot id of a playlist, a cheap way to tell if it changed."""
+
+        url = f"https://api.spotify.com/v1/playlists/{id}"
+
+        return self._apiQuery(url, params={'fields': 'name,snapshot_id'})
+
+    def playlistDetails(self, id):
+        """Return everything about a playlist but its tracks, which only change with its snapshot id."""
+
+        url = f"https://api.spotify.com/v1/playlists/{id}"
+
+        return self._apiQuery(url, params={
+            'fields': 'id,name,description,images,owner(display_name),followers(total),snapshot_id'
+        })
+
+    def playlistTrackIds(self, id):
+        """Return the ids of every track in a playlist, skipping local and unavailable tracks."""
+
+        playlist = self.getPlaylist(id)
+
+        ids = [
+            item['track']['id'] for item in playlist['tracks']['items']
+            if item['track'] and item['track']['id']
+        ]
+
+        return playlist, ids
\ No newline at end of file
@@ -1,12 +1,14 @@
-import base64, os
+import base64, os, threading
 
 from datetime import datetime, timedelta
 
+from flask import current_app
 from flask.globals import session
 
 from badstats.db import get_db
 
 from spotify.WebAPI import WebAPI
+from spotify.Lease import Lease
 
 class Token:
     """Represents a token with an expiration datetime."""
@@ -32,6 +34,11 @@ class Token:
         
         return datetime.utcnow() >= self._expires
 
+    def expiresWithin(self, margin: timedelta) -> bool:
+        """Determines if the token expires within margin from now."""
+
+        return datetime.utcnow() + margin >= self._expires
+
     def value(self) -> str:
         """Get the value of the token."""
 
@@ -48,7 +55,9 @@ class ClientToken(Token):
 
         db = get_db()
 
-        token = db.execute('SELECT * FROM token WHERE token_type="client"').fetchone()
+        token = db.execute(
+            'SELECT * FROM token WHERE token_type="client" ORDER BY expires DESC'
+        ).fetchone()
 
         if token is None:
             raise Exception("No client token found in the database!")
@@ -63,12 +72,58 @@ class ClientToken(Token):
         """Adds a token to the database."""
 
         db = get_db()
-        db.execute(
+        cursor = db.execute(
+                'INSERT INTO token (token, expires, refresh, token_type, sessionid)'
+                ' VALUES (?, ?, ?, ?, ?)',
+                (self._value, self._expires.isoformat(), None, "client", None)
+            )
+        db.commit()
+        self._id = cursor.lastrowid
+
+    def replaceInDatabase(self):
+        """Replaces every client token in the database with this one."""
+
+        db = get_db()
+        db.execute('DELETE FROM token WHERE token_type="client"')
+        cursor = db.execute(
                 'INSERT INTO token (token, expires, refresh, token_type, sessionid)'
                 ' VALUES (?, ?, ?, ?, ?)',
                 (self._value, self._expires.isoformat(), None, "client", None)
             )
         db.commit()
+        self._id = cursor.lastrowid
+
+class ClientTokenCache:
+    """
+    Holds the current ClientToken in memory for every thread in the process.
+
+    Reading the token doesn't take the lock or touch the database, only
+    replacing it does. The token is replaced margin before it expires so
+    requests never go out with a token that is about to expire.
+    """
+
+    def __init__(self, margin: timedelta):
+        self._lock = threading.Lock()
+        self._token = None
+        self._margin = margin
+
+    def token(self, replace):
+        """
+        Return the cached token. If there isn't one yet or it's about to
+        expire, replace is called with the current token (or None) and its
+        result is cached instead.
+        """
+
+        token = self._token
+        if token is not None and not token.expiresWithin(self._margin):
+            return token
+
+        with self._lock:
+            # Another thread may have replaced it while we waited
+            if self._token is None or self._token.expiresWithin(self._margin):
+                self._token = replace(self._token, self._margin)
+
+            return self._token
 
 class UserToken(Token):
 
@@ -118,8 +173,8 @@ class UserToken(Token):
         self._refreshTokenValue = refreshToken
 
         db = get_db()
-        db.execute("UPDATE token SET token=?, expires=? WHERE sessionid=?", 
-                    (self._value, self._expires, self._sessionid)
+        db.execute("UPDATE token SET token=?, expires=?, refresh=? WHERE sessionid=?", 
+                    (self._value, self._expires.isoformat(), self._refreshTokenValue, self._sessionid)
         )
         db.commit()
 
@@ -168,14 +223,35 @@ class BasicCreds(Creds):
 
     def __init__(self):
 
-        try:
-            self._token = ClientToken.fromDatabase()
-        except:
-            self._token = self._getNewToken()
-        
-        if self._token.isExpired():
-            self._token.removeFromDatabase()
-            self._token = self._getNewToken()
+        self._token = self._cache().token(self._replaceToken)
+
+    @staticmethod
+    def _cache():
+        """Return the ClientTokenCache shared by the app."""
+
+        cache = current_app.extensions.get('spotify.client_token')
+        if cache is None:
+            margin = timedelta(seconds=current_app.config.get('CLIENT_TOKEN_REFRESH_MARGIN', 60))
+            cache = current_app.extensions.setdefault('spotify.client_token', ClientTokenCache(margin))
+
+        return cache
+
+    def _replaceToken(self, token, margin):
+        """
+        Load the token from the database, or request a new one if it's about
+        to expire. Only one caller across every replica requests it, the rest
+        wait for it to show up in the database.
+        """
+
+        def fresh():
+            try:
+                stored = ClientToken.fromDatabase()
+            except:
+                return None
+
+            return None if stored.expiresWithin(margin) else stored
+
+        return Lease("client_token").run(fresh, self._getNewToken)
 
     def _getNewToken(self):
         """Request a new ClientToken"""
@@ -184,7 +260,7 @@ class BasicCreds(Creds):
 
         token = ClientToken(response["access_token"], self._expires(response))
 
-        token.addToDatabase()
+        token.replaceInDatabase()
 
         return token
 
@@ -193,23 +269,45 @@ class UserCreds(Creds):
 
     def __init__(self, sessionid):
 
+        self._sessionid = sessionid
         self._token = UserToken.fromDatabase(sessionid)
 
         if self._token.isExpired():
             self._refreshToken()
         
     def _refreshToken(self):
-        """Uses the refresh token to get a new auth token."""
+        """
+        Uses the refresh token to get a new auth token. Only one caller for a
+        session refreshes it, the rest wait for the new token in the database.
+        """
 
-        response = self._tokenRequest({
-            'grant_type': 'refresh_token',
-            'refresh_token': self._token.refreshTokenValue()
-        })
+        def fresh():
+            token = UserToken.fromDatabase(self._sessionid)
+            return None if token.isExpired() else token
 
-        self._token.refresh(
-            response['access_token'],
-            self._expires(response),
-        )
+        def refresh():
+            # Use the latest refresh token in case the last refresh rotated it
+            token = UserToken.fromDatabase(self._sessionid)
+
+            response = self._tokenRequest({
+                'grant_type': 'refresh_token',
+                'refresh_token': token.refreshTokenValue()
+            })
+
+            # Spotify only sometimes sends a new refresh token
+            refreshToken = token.refreshTokenValue()
+            if 'refresh_token' in response:
+                refreshToken = response['refresh_token']
+
+            token.refresh(
+                response['access_token'],
+                self._expires(response),
+                refreshToken,
+            )
+
+            return token
+
+        self._token = Lease(f"user:{self._sessionid}").run(fresh, refresh)
 
     @classmethod
     def fromCode(cls, code, url, sessionid):
@@ -0,0 +1,192 @@
+import io, warnings
+
+import numpy as np
+
+from spotify.Features import FeatureStore
+
+class TrackTable:
+    """
+    Tracks held as columns rather than a list of dicts: an array of ids, one
+    of names and a float array per feature, with NaN where a track has no
+    value for it (e.g. no audio features).
+
+    Analytics over a whole album or playlist work on the arrays directly
+    instead of walking every track's dict for each feature.
+    """
+
+    features = ('popularity',) + FeatureStore.columns
+
+    # Names of the pitch classes spotify numbers keys by
+    keys = ('C', 'C♯/D♭', 'D', 'D♯/E♭', 'E', 'F', 'F♯/G♭', 'G', 'G♯/A♭', 'A', 'A♯/B♭', 'B')
+
+    percentiles = (10, 25, 50, 75, 90)
+
+    # Beats per minute in each bar of the tempo histogram
+    tempoBinWidth = 10
+
+    def __init__(self, ids, names, columns):
+        self.ids = np.asarray(ids, dtype=object)
+        self.names = np.asarray(names, dtype=object)
+        self._columns = {feature: np.asarray(values, dtype=float) for feature, values in columns.items()}
+
+        for feature, values in self._columns.items():
+            if len(values) != len(self.ids):
+                raise Exception(f"Column {feature} has {len(values)} values for {len(self.ids)} tracks.")
+
+    @classmethod
+    def fromTracks(cls, tracks, features=None):
+        """
+        Build a table from tracks as returned by Spotify, with their audio
+        features merged in, keeping only features if given.
+        """
+
+        tracks = [track for track in tracks if track is not None]
+        features = features or cls.features
+
+        # None becomes NaN in a float array
+        return cls(
+            [track.get('id') for track in tracks],
+            [track.get('name') for track in tracks],
+            {feature: [track.get(feature) for track in tracks] for feature in features},
+        )
+
+    def toBytes(self):
+        """Serialize the table, e.g. to keep it in the database."""
+
+        buffer = io.BytesIO()
+        np.savez_compressed(
+            buffer,
+            ids=self.ids.astype(str),
+            names=self.names.astype(str),
+            **{f'column_{feature}': values for feature, values in self._columns.items()}
+        )
+
+        return buffer.getvalue()
+
+    @classmethod
+    def fromBytes(cls, data):
+        """Rebuild a table serialized by toBytes."""
+
+        with np.load(io.BytesIO(data), allow_pickle=False) as arrays:
+            return cls(
+                arrays['ids'].astype(object),
+                arrays['names'].astype(object),
+                {name[len('column_'):]: arrays[name] for name in arrays.files if name.startswith('column_')},
+            )
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, feature):
+        return feature in self._columns
+
+    def columns(self):
+        """The features the table has a column for."""
+
+        return tuple(self._columns)
+
+    def column(self, feature):
+        """The values of feature for every track, NaN where a track has none."""
+
+        return self._columns[feature]
+
+    def present(self, feature):
+        """Return (names, values) of the tracks that have a value for feature."""
+
+        values = self._columns[feature]
+        mask = ~np.isnan(values)
+
+        return self.names[mask], values[mask]
+
+
+    def summary(self, features):
+        """
+        Summary statistics of the tracks: the count, mean, standard deviation,
+        min, max and percentiles of each of features, how many tracks are in
+        each key and mode, and a histogram of their tempo. Missing values are
+        left out, and a statistic with no values is None.
+        """
+
+        values = np.column_stack([self._columns[feature] for feature in features])
+
+        # Features every track is missing warn about empty slices
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+
+            counts = np.count_nonzero(~np.isnan(values), axis=0)
+            means = np.nanmean(values, axis=0)
+            stds = np.nanstd(values, axis=0)
+
+            # These can't reduce over no tracks at all
+            if len(self):
+                mins = np.nanmin(values, axis=0)
+                maxs = np.nanmax(values, axis=0)
+                percentiles = np.nanpercentile(values, self.percentiles, axis=0)
+            else:
+                mins = maxs = np.full(len(features), np.nan)
+                percentiles = np.full((len(self.percentiles), len(features)), np.nan)
+
+        return {
+            'tracks': len(self),
+            'features': {
+                feature: {
+                    'count': int(counts[i]),
+                    'mean': _number(means[i]),
+                    'std': _number(stds[i]),
+                    'min': _number(mins[i]),
+                    'max': _number(maxs[i]),
+                    'percentiles': {
+                        str(percentile): _number(percentiles[j, i])
+                        for j, percentile in enumerate(self.percentiles)
+                    },
+                }
+                for i, feature in enumerate(features)
+            },
+            'keys': self._keyCounts(),
+            'modes': self._modeCounts(),
+            'tempo': self._tempoHistogram(),
+        }
+
+    def _keyCounts(self):
+        if 'key' not in self:
+            return {}
+
+        # -1 means spotify couldn't detect the key
+        keys = self._columns['key']
+        keys = keys[keys >= 0].astype(int)
+        counts = np.bincount(keys, minlength=len(self.keys))
+
+        return dict(zip(self.keys, counts.tolist()))
+
+    def _modeCounts(self):
+        if 'mode' not in self:
+            return {}
+
+        modes = self._columns['mode']
+
+        return {
+            'major': int(np.count_nonzero(modes == 1)),
+            'minor': int(np.count_nonzero(modes == 0)),
+        }
+
+    def _tempoHistogram(self):
+        if 'tempo' not in self:
+            return {'edges': [], 'counts': []}
+
+        tempos = self._columns['tempo']
+        tempos = tempos[~np.isnan(tempos)]
+        if not len(tempos):
+            return {'edges': [], 'counts': []}
+
+        # Bins start on multiples of the width, the last one past the fastest tempo
+        width = self.tempoBinWidth
+        first, last = np.floor(tempos.min() / width), np.floor(tempos.max() / width)
+        edges = width * np.arange(first, last + 2)
+        counts, edges = np.histogram(tempos, bins=edges)
+
+        return {'edges': edges.tolist(), 'counts': counts.tolist()}
+
+def _number(value):
+    """A float that can be serialized, None for NaN."""
+
+    return None if np.isnan(value) else float(value)
@@ -1,10 +1,124 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
+from requests.adapters import HTTPAdapter
+
+class SessionPool:
+    """
+    Keeps alive pooled HTTP connections to the spotify web api.
+
+    Each thread gets its own requests Session, but every session mounts the
+    same adapters so the underlying per-host connection pools are shared
+    between threads. Requests that should run concurrently are submitted to a
+    worker pool no larger than the connection pool.
+    """
+
+    # Hosts that get a dedicated connection pool
+    hosts = (
+        "https://api.spotify.com",
+        "https://accounts.spotify.com",
+    )
+
+    def __init__(self, poolSize=4):
+        """Create the shared adapters, poolSize is the max connections kept per host."""
+
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.configure(poolSize)
+
+    def configure(self, poolSize):
+        """(Re)create the adapters, poolSize should match the number of server threads."""
+
+        if poolSize < 1:
+            raise Exception("Connection pool size must be at least 1.")
+
+        with self._lock:
+            self._poolSize = poolSize
+            self._adapters = {
+                host: HTTPAdapter(pool_connections=1, pool_maxsize=poolSize)
+                for host in self.hosts
+            }
+            self._adapters["https://"] = HTTPAdapter(pool_maxsize=poolSize)
+
+            if getattr(self, "_executor", None) is not None:
+                self._executor.shutdown(wait=False)
+            self._executor = None
+
+            # Sessions made with the old adapters are replaced on next use
+            self._generation = getattr(self, "_generation", 0) + 1
+
+    def poolSize(self):
+        return self._poolSize
+
+    def session(self):
+        """Return the session for the calling thread."""
+
+        local = self._local
+        if getattr(local, "generation", None) != self._generation:
+            with self._lock:
+                session = requests.Session()
+                for prefix, adapter in self._adapters.items():
+                    session.mount(prefix, adapter)
+                local.session = session
+                local.generation = self._generation
+
+        return local.session
+
+    def executor(self):
+        """Return the worker pool used for concurrent requests, created on first use."""
+
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self._poolSize,
+                    thread_name_prefix="spotify-webapi"
+                )
+            return self._executor
+
+    def get(self, *args, **kwargs):
+        return self.session().get(*args, **kwargs)
+
+    def post(self, *args, **kwargs):
+        return self.session().post(*args, **kwargs)
+
+    def stats(self):
+        """
+        Return connection reuse stats for each host that has been contacted.
+
+        'requests' is the number of requests sent through the pool and
+        'connections' the number of connections that had to be opened for them.
+        """
+
+        stats = {}
+        with self._lock:
+            adapters = list(self._adapters.values())
+
+        for adapter in adapters:
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+
+                host = f"{pool.scheme}://{pool.host}"
+                entry = stats.setdefault(host, {"requests": 0, "connections": 0})
+                entry["requests"] += pool.num_requests
+                entry["connections"] += pool.num_connections
+
+        for entry in stats.values():
+            entry["reused"] = max(entry["requests"] - entry["connections"], 0)
+
+        return stats
 
 class WebAPI:
     """
     Handles requests to and responses from the spotify web api.
     """
 
+    # Shared by every request in the process
+    _pool = SessionPool()
+
     def __init__(self, response):
         """Takes in a requests module Reponse object and extracts necessary information."""
 
@@ -21,17 +135,52 @@ class WebAPI:
         if self._statusCode >= 300:
             raise Exception(f"API Query Error, status code: {self._statusCode}, response: {self._rawResponse}")
 
+    @classmethod
+    def configure(cls, poolSize):
+        """Set how many keep-alive connections are pooled per host."""
+
+        cls._pool.configure(poolSize)
+
+    @classmethod
+    def poolStats(cls):
+        """Return connection reuse stats for the shared session pool."""
+
+        return cls._pool.stats()
+
+    @classmethod
+    def executor(cls):
+        """Return the shared worker pool, its size limits the concurrent requests."""
+
+        return cls._pool.executor()
+
+    @classmethod
+    def submit(cls, fn, *args, **kwargs):
+        """Run fn on the shared worker pool, returns a Future."""
+
+        return cls._pool.executor().submit(fn, *args, **kwargs)
+
     @classmethod
     def get(cls, *args, **kwargs):
         """Send get request and instantiate the class with the response."""
 
-        return cls(requests.get(*args, **kwargs))
+        return cls(cls._pool.get(*args, **kwargs))
+
+    @classmethod
+    def rawGet(cls, *args, **kwargs):
+        """Send get request and return the requests Response as is."""
+
+        return cls._pool.get(*args, **kwargs)
 
     @classmethod
     def post(cls, *args, **kwargs):
         """Send post request and instantiate the class with the response."""
 
-        return cls(requests.post(*args, **kwargs))
+        return cls(cls._pool.post(*args, **kwargs))
+
+    def rawResponse(self):
+        """Return the requests module Response this was made from."""
+
+        return self._rawResponse
 
     def json(self):
         """Return a json representation of the response from the Spotify API."""
@@ -43,6 +192,9 @@ class WebAPI:
 
         return self._content[key]
 
+    def __contains__(self, key):
+        return key in self._content
+
     def __str__(self):
         return str(self._content)
 
@@ -50,4 +202,4 @@ class WebAPI:
         return iter(self._content.items())
 
     def update(self, data):
-        self._content.update(data)
\ No newline at end of file
+        self._content.update(data)
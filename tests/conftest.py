@@ -1,12 +1,13 @@
-import os, base64, requests
-import tempfile
-from datetime import datetime, timezone
+import os, base64, json
+import tempfile, shutil
+from datetime import datetime, timedelta, timezone
 
 import pytest
 
 import badstats.db
 from badstats import create_app
 from badstats.db import get_db, init_db
+from spotify.WebAPI import WebAPI
 
 with open(os.path.join(os.path.dirname(__file__), 'data.sql'), 'rb') as f:
     _data_sql = f.read().decode('utf8')
@@ -15,10 +16,12 @@ with open(os.path.join(os.path.dirname(__file__), 'data.sql'), 'rb') as f:
 @pytest.fixture
 def app():
     db_fd, db_path = tempfile.mkstemp()
+    plot_path = tempfile.mkdtemp()
 
     app = create_app({
         'TESTING': True,
         'DATABASE': db_path,
+        'PLOT_CACHE_FOLDER': plot_path,
     })
 
     with app.app_context():
@@ -29,6 +32,7 @@ def app():
 
     os.close(db_fd)
     os.unlink(db_path)
+    shutil.rmtree(plot_path)
 
 
 @pytest.fixture
@@ -72,11 +76,16 @@ class FakeResponse:
             'date': date.strftime('%a, %d %b %Y %H:%M:%S %Z')
         }
 
+    @property
+    def content(self):
+        return json.dumps(self.jsondata).encode('utf-8')
+
     def json(self):
         self.jsondata.update({
             'expires_in': 5 # 5 seconds
         })
-        return self.jsondata
+        # Parse a fresh copy each time like requests does
+        return json.loads(self.content)
 
 @pytest.fixture
 def fake_response():
@@ -115,7 +124,7 @@ def mock_spotify_auth(monkeypatch, spotify_creds):
         else:
             raise Exception("Wrong url sent to Spotify api")
 
-    monkeypatch.setattr(requests, "post", mock_post)
+    monkeypatch.setattr(WebAPI._pool, "post", mock_post)
 
 @pytest.fixture
 def failedQuery(monkeypatch):
@@ -125,7 +134,7 @@ def failedQuery(monkeypatch):
         return {"status_code": statusCode}
 
     def _failedQuery(statusCode):
-        monkeypatch.setattr(requests, "get", _makeFailedQuery(statusCode))
+        monkeypatch.setattr(WebAPI._pool, "get", _makeFailedQuery(statusCode))
     
     return _failedQuery
 
@@ -137,3 +146,110 @@ def dbReturnsNone(monkeypatch):
         return None
     monkeypatch.setattr(badstats.db, "get_db", returnNone)
 
+@pytest.fixture
+def fake_catalog(monkeypatch, spotify_creds):
+    """
+    Serves artists and their top tracks, albums (with three tracks each),
+    playlists (with two tracks each), /v1/tracks and /v1/audio-features for
+    any ids without touching the network. Returns the list of (url, params)
+    that were requested.
+    """
+
+    requested = []
+    albums = "https://api.spotify.com/v1/albums/"
+    artists = "https://api.spotify.com/v1/artists/"
+    playlists = "https://api.spotify.com/v1/playlists/"
+
+    def mock_get(url, headers=None, params=None):
+        requested.append((url, params))
+
+        if url.startswith(albums):
+            id = url[len(albums):]
+            return FakeResponse(json={
+                'id': id,
+                'name': f'album {id}',
+                'tracks': {
+                    'items': [{'id': f'{id}-{n}', 'name': f'track {n}', 'track_number': n} for n in (3, 1, 2)],
+                    'limit': 50, 'offset': 0, 'total': 3, 'next': None,
+                },
+            })
+
+        if url.startswith(artists):
+            id = url[len(artists):]
+            if id.endswith('/top-tracks'):
+                return FakeResponse(json={'tracks': [{'id': 'top', 'name': 'top track'}]})
+            return FakeResponse(json={'id': id, 'name': f'artist {id}'})
+
+        if url.startswith(playlists):
+            id = url[len(playlists):]
+            playlist = {
+                'id': id,
+                'name': f'playlist {id}',
+                'description': '',
+                'images': [],
+                'owner': {'display_name': 'owner'},
+                'followers': {'total': 1},
+                'snapshot_id': f'{id}-snapshot',
+            }
+
+            # Only the fields asked for, without the tracks
+            if params and 'fields' in params:
+                return FakeResponse(json=playlist)
+
+            return FakeResponse(json=dict(playlist, tracks={
+                'items': [
+                    {'track': {
+                        'id': f'{id}-{n}',
+                        'name': f'track {n}',
+                        'album': {'id': 'album', 'name': 'album', 'artists': [{'id': 'artist', 'name': 'artist'}]},
+                    }}
+                    for n in (1, 2)
+                ],
+                'limit': 100, 'offset': 0, 'total': 2, 'next': None,
+            }))
+
+        ids = params['ids'].split(',')
+
+        if url == "https://api.spotify.com/v1/tracks":
+            return FakeResponse(json={'tracks': [
+                {'id': id, 'name': f'name {id}', 'popularity': 50, 'duration_ms': 200000}
+                for id in ids
+            ]})
+        elif url == "https://api.spotify.com/v1/audio-features":
+            return FakeResponse(json={'audio_features': [
+                None if id.startswith('missing') else {
+                    'id': id, 'energy': 0.5, 'danceability': 0.6, 'tempo': 120.0, 'loudness': -6.0,
+                    'speechiness': 0.05, 'acousticness': 0.1, 'instrumentalness': 0.0,
+                    'liveness': 0.2, 'valence': 0.7, 'key': 5, 'mode': 1, 'duration_ms': 200000,
+                }
+                for id in ids
+            ]})
+        else:
+            raise Exception(f"Unexpected url sent to Spotify api: {url}")
+
+    def mock_post(url, data, headers):
+        return FakeResponse(json={"access_token": "fake_client_token"}, date=datetime.now(timezone.utc))
+
+    monkeypatch.setattr(WebAPI._pool, "get", mock_get)
+    monkeypatch.setattr(WebAPI._pool, "post", mock_post)
+
+    return requested
+
+@pytest.fixture
+def user_session(app, client):
+    """Logs the client in to spotify with a user token that won't expire during the test."""
+
+    with app.app_context():
+        db = get_db()
+        db.execute(
+            'INSERT INTO token (token, expires, refresh, token_type, sessionid)'
+            ' VALUES (?, ?, ?, ?, ?)',
+            ('fake_auth_token', (datetime.utcnow() + timedelta(hours=1)).isoformat(), 'fake_refresh_token', 'auth', 'session')
+        )
+        db.commit()
+
+    with client.session_transaction() as session:
+        session['id'] = 'session'
+        session['created'] = datetime.utcnow().isoformat()
+
+    return 'session'
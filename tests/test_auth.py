@@ -1,6 +1,8 @@
 import pytest
 from flask import g, session
+from badstats import create_app
 from badstats.db import get_db
+from badstats.auth import issueCsrf, isValid
 
 
 # def test_register(client, app):
@@ -53,3 +55,51 @@ from badstats.db import get_db
 #     with client:
 #         auth.logout()
 #         assert 'user_id' not in session
+
+@pytest.mark.parametrize('mode', ('signed', 'database'))
+def test_csrf_single_use(app, mode):
+    app.config['CSRF_MODE'] = mode
+
+    with app.app_context():
+        csrf = issueCsrf()
+
+        assert isValid(csrf)
+        assert isValid(csrf)
+        assert isValid(csrf, consume=True)
+        assert not isValid(csrf)
+        assert not isValid(csrf, consume=True)
+
+def test_csrf_signed_without_database(app):
+    with app.app_context():
+        csrf = issueCsrf()
+
+        assert get_db().execute('SELECT * FROM csrf').fetchone() is None
+        assert isValid(csrf)
+        assert not isValid(csrf + "x")
+        assert not isValid("")
+
+def test_csrf_signed_single_use_across_replicas(app):
+    # Another replica sharing the database
+    other = create_app(dict(app.config))
+
+    with app.app_context():
+        csrf = issueCsrf()
+        assert isValid(csrf, consume=True)
+
+    with other.app_context():
+        assert not isValid(csrf)
+        assert not isValid(csrf, consume=True)
+
+def test_csrf_signed_expired(app):
+    with app.app_context():
+        csrf = issueCsrf()
+
+        app.config['CSRF_MAX_AGE'] = -1
+        assert not isValid(csrf)
+
+def test_csrf_signed_other_secret(app):
+    with app.app_context():
+        csrf = issueCsrf()
+
+        app.config['SECRET_KEY'] = 'other'
+        assert not isValid(csrf)
@@ -1,6 +1,7 @@
 import pytest
 from badstats.db import get_db
 from flask import url_for
+from badstats.render import RenderService, _renderJob
 
 @pytest.mark.parametrize('path', (
     '/',
@@ -52,6 +53,187 @@ def test_plot(client, path):
     response = client.get(path)
     assert response.status_code == 200
 
+def test_plot_page_links_image(client):
+    response = client.get("/plot/album/energy/4sgYpkIASM1jVlNC8Wp9oF")
+    assert b'src="/plot/album/energy/4sgYpkIASM1jVlNC8Wp9oF/image"' in response.data
+
+def test_plot_image_revalidation(client, fake_catalog):
+    response = client.get("/plot/album/energy/test.png")
+
+    assert response.status_code == 200
+    assert response.mimetype == 'image/png'
+    assert response.data.startswith(b'\x89PNG')
+    assert 'public' in response.headers['Cache-Control']
+    assert response.last_modified is not None
+
+    etag = response.headers['ETag']
+    response = client.get("/plot/album/energy/test.png", headers={'If-None-Match': etag})
+
+    assert response.status_code == 304
+    assert response.data == b''
+
+def test_plot_image_cached(client, fake_catalog):
+    first = client.get("/plot/album/energy/test.png")
+    requests = len(fake_catalog)
+
+    second = client.get("/plot/album/energy/test.png")
+
+    assert len(fake_catalog) == requests
+    assert second.data == first.data
+    assert client.get("/plot/album/tempo/test.png").data != first.data
+
+def test_plot_unknown_kind(client):
+    assert client.get("/plot/album/nonsense/test.png").status_code == 404
+
+@pytest.mark.parametrize('query, accept, mimetype', (
+    ('', None, 'image/png'),
+    ('', 'image/svg+xml', 'image/svg+xml'),
+    ('', 'image/webp,image/*;q=0.8', 'image/webp'),
+    ('', 'image/png,image/webp;q=0.5', 'image/png'),
+    ('', 'image/avif,image/webp,image/apng,image/svg+xml,image/*,*/*;q=0.8', 'image/webp'),
+    ('', 'image/avif,image/webp,*/*', 'image/webp'),
+    ('?format=webp&dpi=50', 'image/svg+xml', 'image/webp'),
+))
+def test_plot_image_format(client, fake_catalog, query, accept, mimetype):
+    headers = {'Accept': accept} if accept else {}
+    response = client.get(f"/plot/album/energy/test/image{query}", headers=headers)
+
+    assert response.status_code == 200
+    assert response.mimetype == mimetype
+    assert 'Accept' in response.headers['Vary']
+
+def test_plot_image_format_metrics(app, client, fake_catalog):
+    small = client.get("/plot/album/energy/test/image?format=png&dpi=50")
+    large = client.get("/plot/album/energy/test/image?format=png&dpi=1000")
+
+    # Dpis round to the nearest preset, so these are the same image
+    assert client.get("/plot/album/energy/test/image?format=png&dpi=80").data == small.data
+    assert len(small.data) < len(large.data)
+
+    with app.app_context():
+        from badstats.plotcache import get_render_cache
+        formats = get_render_cache().stats()['formats']
+
+    assert formats['png']['images'] == 2
+    assert formats['png']['bytes'] > 0
+
+def test_plot_image_unknown_format(client):
+    assert client.get("/plot/album/energy/test/image?format=gif").status_code == 400
+
+def test_plot_still_rendering(monkeypatch, client, fake_catalog):
+    # The pool timed out and is still rendering the plot
+    monkeypatch.setattr(RenderService, 'render', lambda self, name, *args, done=None: None)
+
+    response = client.get("/plot/album/energy/test.png")
+
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '5'
+
+def test_plot_reuses_tracks(client, fake_catalog):
+    client.get("/plot/album/energy/test.png")
+    requests = len(fake_catalog)
+
+    # Another kind is drawn from the tracks kept from the first plot
+    response = client.get("/plot/album/tempo/test.png")
+
+    assert response.status_code == 200
+    assert len(fake_catalog) == requests
+
+def test_plot_bundle(monkeypatch, app, client, fake_catalog):
+    app.config['PLOT_BUNDLE'] = True
+    background = []
+
+    def render(self, name, *args, done):
+        background.append(args[0])
+        done(_renderJob(name, args))
+        return True
+
+    monkeypatch.setattr(RenderService, 'background', render)
+
+    response = client.get("/plot/album/energy/test.png")
+
+    # Only the other kinds are left for the background
+    assert response.status_code == 200
+    assert len(background) == 1 and 'energy' not in background[0]
+
+    with app.app_context():
+        from badstats.plotcache import get_render_cache
+        assert get_render_cache().stats()['formats']['png']['images'] == 11
+
+    response = client.get("/plot/album/tempo/test.png")
+
+    assert response.status_code == 200
+    assert len(background) == 1
+
+def test_plot_all_kinds(client, fake_catalog):
+    client.get("/plot/album/energy/test.png")
+    requests = len(fake_catalog)
+
+    # The grid is drawn from the tracks kept from the first plot
+    response = client.get("/plot/album/all/test.png")
+
+    assert response.status_code == 200
+    assert response.data.startswith(b'\x89PNG')
+    assert len(fake_catalog) == requests
+
+def test_album_summary(client, fake_catalog):
+    response = client.get("/summary/album/test.json")
+
+    assert response.status_code == 200
+    summary = response.get_json()
+    assert summary['tracks'] == 3
+    assert summary['features']['tempo']['mean'] == 120.0
+    assert summary['features']['tempo']['percentiles']['50'] == 120.0
+    assert summary['keys']['F'] == 3
+    assert summary['modes'] == {'major': 3, 'minor': 0}
+    assert summary['tempo']['counts'] == [3]
+
+    # The page is built from the same cached tracks
+    requests = len(fake_catalog)
+    response = client.get("/summary/album/test")
+
+    assert response.status_code == 200
+    assert b'120-130 BPM: 3' in response.data
+    assert len(fake_catalog) == requests
+
+def test_user_playlist_revalidates(client, fake_catalog, user_session):
+    response = client.get("/user/playlist/test")
+
+    assert response.status_code == 200
+    assert b'track 1' in response.data
+    etag = response.headers['ETag']
+
+    # Unchanged details mean the tracks aren't fetched again
+    requests = len(fake_catalog)
+    response = client.get("/user/playlist/test", headers={'If-None-Match': etag})
+
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
+    assert all(params for url, params in fake_catalog[requests:])
+
+def test_user_playlist_snapshot_reused(app, client, fake_catalog, user_session):
+    response = client.get("/user/playlist/test/summary.json")
+
+    assert response.status_code == 200
+    assert response.get_json()['tracks'] == 2
+
+    # With the same snapshot id the stored tracks are used even once the
+    # cached table is gone
+    app.extensions.pop('badstats.track_tables')
+    requests = len(fake_catalog)
+
+    assert client.get("/user/playlist/test/summary.json").get_json()['tracks'] == 2
+    assert client.get("/user/playlist/test/plot/energy/image?format=svg").status_code == 200
+
+    urls = [url for url, params in fake_catalog[requests:]]
+    assert "https://api.spotify.com/v1/tracks" not in urls
+    assert "https://api.spotify.com/v1/audio-features" not in urls
+
+def test_compare_needs_session(client):
+    response = client.get("/user/playlist/compare?ids=a,b")
+
+    assert response.status_code == 302
+
 # @pytest.mark.parametrize('path', (
 #     '/create',
 #     '/1/update',
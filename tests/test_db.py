@@ -1,7 +1,8 @@
-import sqlite3
+import threading
+from datetime import datetime, timedelta
 
-import pytest
-from badstats.db import get_db
+from badstats.db import get_db, migrate_db
+from badstats.janitor import prune
 
 
 def test_get_close_db(app):
@@ -9,10 +10,44 @@ def test_get_close_db(app):
         db = get_db()
         assert db is get_db()
 
-    with pytest.raises(sqlite3.ProgrammingError) as e:
-        db.execute('SELECT 1')
+    # The thread keeps its connection for the next app context
+    with app.app_context():
+        assert db is get_db()
+        assert db.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+
+    connections = []
 
-    assert 'closed' in str(e.value)
+    def otherThread():
+        with app.app_context():
+            connections.append(get_db())
+
+    thread = threading.Thread(target=otherThread)
+    thread.start()
+    thread.join()
+
+    assert connections[0] is not db
+
+def test_close_db_discards_uncommitted(app):
+    with app.app_context():
+        get_db().execute('DELETE FROM token')
+
+    with app.app_context():
+        assert get_db().in_transaction is False
+
+def test_migrate_db(app):
+    with app.app_context():
+        db = get_db()
+        db.executescript(
+            'DROP TABLE lease; DROP INDEX token_sessionid; DROP INDEX csrf_token; PRAGMA user_version = 0;'
+        )
+
+        assert migrate_db() > 0
+        assert migrate_db() == 0
+
+        names = [row['name'] for row in db.execute('SELECT name FROM sqlite_master')]
+        assert 'lease' in names
+        assert 'token_sessionid' in names
+        assert 'csrf_token' in names
 
 def test_init_db_command(runner, monkeypatch):
     class Recorder(object):
@@ -24,4 +59,35 @@ def test_init_db_command(runner, monkeypatch):
     monkeypatch.setattr('badstats.db.init_db', fake_init_db)
     result = runner.invoke(args=['init-db'])
     assert 'Initialized' in result.output
-    assert Recorder.called
\ No newline at end of file
+    assert Recorder.called
+
+def test_prune(app):
+    old = (datetime.utcnow() - timedelta(hours=1)).isoformat()
+    new = (datetime.utcnow() + timedelta(hours=1)).isoformat()
+
+    with app.app_context():
+        db = get_db()
+        db.executemany(
+            'INSERT INTO csrf (token, created) VALUES (?, ?)',
+            [('old', old)] * 5 + [('new', datetime.utcnow().isoformat())]
+        )
+        db.executemany(
+            'INSERT INTO token (token, expires, refresh, token_type, sessionid) VALUES (?, ?, ?, ?, ?)',
+            [('old', old, 'refresh', 'auth', 'old'), ('new', new, 'refresh', 'auth', 'new')]
+        )
+        db.executemany(
+            'INSERT INTO csrf_used (nonce, used) VALUES (?, ?)',
+            [('old', old), ('new', datetime.utcnow().isoformat())]
+        )
+        db.commit()
+
+        assert prune(batchSize=2, pause=0) == {'csrf': 5, 'csrf_used': 1, 'token': 1, 'lease': 0, 'playlist_snapshot': 0}
+
+        assert [row['token'] for row in db.execute('SELECT token FROM csrf')] == ['new']
+        assert [row['token'] for row in db.execute('SELECT token FROM token')] == ['new']
+        assert [row['nonce'] for row in db.execute('SELECT nonce FROM csrf_used')] == ['new']
+        assert db.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+
+def test_prune_db_command(runner):
+    result = runner.invoke(args=['prune-db'])
+    assert 'rows deleted' in result.output
@@ -1,6 +1,9 @@
-import os
+import os, subprocess, sys
+
+import pytest
 
 from badstats import create_app, getHostname
+from badstats.warmup import WarmUp
 
 
 def test_config():
@@ -14,4 +17,60 @@ def test_hostname(monkeypatch):
     assert getHostname() == "http://127.0.0.1:5000"
 
     monkeypatch.setenv("REDIRECT_HOSTNAME", "Testing")
-    assert getHostname() == "Testing"
\ No newline at end of file
+    assert getHostname() == "Testing"
+
+def test_create_app_skips_numpy(tmp_path):
+    # Plotting libraries only load once something is plotted, check in a
+    # fresh interpreter since other tests have imported them already
+    code = (
+        "import sys\n"
+        "from badstats import create_app\n"
+        f"create_app({{'TESTING': True, 'DATABASE': {str(tmp_path / 'badstats.sqlite')!r}}})\n"
+        "assert 'numpy' not in sys.modules and 'matplotlib' not in sys.modules\n"
+    )
+
+    subprocess.run([sys.executable, '-c', code], check=True)
+
+def test_ready_without_warmup(client):
+    assert client.get('/ready').status_code == 200
+
+def test_ready_after_warmup(monkeypatch, tmp_path):
+    monkeypatch.setattr(WarmUp, '_clientToken', staticmethod(lambda: None))
+
+    app = create_app({
+        'TESTING': True,
+        'DATABASE': str(tmp_path / 'badstats.sqlite'),
+        'PLOT_CACHE_FOLDER': str(tmp_path / 'plots'),
+        'WARMUP': True,
+    })
+
+    assert app.extensions['badstats.warmup'].wait(timeout=60)
+    assert app.test_client().get('/ready').status_code == 200
+
+@pytest.mark.parametrize('processes, warmed', ((0, 1), (1, 0)))
+def test_warmup_plots_without_workers(monkeypatch, tmp_path, processes, warmed):
+    calls = []
+    monkeypatch.setattr(WarmUp, '_clientToken', staticmethod(lambda: None))
+    monkeypatch.setattr(WarmUp, '_renderWorkers', lambda self: None)
+    monkeypatch.setattr('badstats.warmup.warmUpRendering', lambda: calls.append(True))
+
+    app = create_app({
+        'TESTING': True,
+        'DATABASE': str(tmp_path / 'badstats.sqlite'),
+        'WARMUP': True,
+        'RENDER_PROCESSES': processes,
+    })
+
+    assert app.extensions['badstats.warmup'].wait(timeout=60)
+    assert len(calls) == warmed
+
+def test_not_ready_while_warming_up(monkeypatch, tmp_path):
+    monkeypatch.setattr(WarmUp, 'start', lambda self: None)
+
+    app = create_app({
+        'TESTING': True,
+        'DATABASE': str(tmp_path / 'badstats.sqlite'),
+        'WARMUP': True,
+    })
+
+    assert app.test_client().get('/ready').status_code == 503
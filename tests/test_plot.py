@@ -0,0 +1,157 @@
+import os, struct, threading, time
+
+from badstats.plotcache import RenderCache
+from badstats.render import RenderService
+
+def test_renderCache_memory_and_disk(tmp_path):
+    cache = RenderCache(str(tmp_path), memoryBytes=100, diskBytes=100, ttl=60)
+    key = cache.key('album', 'id', 'energy', 'png')
+
+    assert cache.get(key) is None
+
+    stored = cache.put(key, b'image')
+    assert cache.get(key) == stored
+
+    # A new process (or replica) finds the plot on disk
+    other = RenderCache(str(tmp_path), memoryBytes=100, diskBytes=100, ttl=60)
+    assert other.get(key).data == b'image'
+    assert other.get(key).etag == stored.etag
+
+    assert cache.stats()['memory_hits'] == 1
+    assert other.stats()['disk_hits'] == 1
+    assert other.stats()['memory_hits'] == 1
+
+def test_renderCache_ttl(tmp_path):
+    cache = RenderCache(str(tmp_path), memoryBytes=100, diskBytes=100, ttl=0)
+    key = cache.key('album', 'id', 'energy', 'png')
+
+    cache.put(key, b'image')
+
+    assert cache.get(key) is None
+
+def test_renderCache_caps(tmp_path):
+    cache = RenderCache(str(tmp_path), memoryBytes=10, diskBytes=10, ttl=60)
+    keys = [cache.key('album', id) for id in 'abc']
+
+    for age, key in enumerate(keys):
+        cache.put(key, b'12345')
+        # Make sure the files have different modification times
+        os.utime(cache._path(key), (time.time() - 10 + age,) * 2)
+
+    assert cache.stats()['memory_bytes'] == 10
+    assert cache.get(keys[0]) is None
+    assert len(os.listdir(tmp_path)) == 2
+
+def test_renderService_inline():
+    service = RenderService(0, queueSize=1, timeout=1)
+    service.start()
+
+    data = service.render('playlist', 'energy', [{'name': 'test', 'energy': 0.5}], 'test')
+
+    assert data.startswith(b'\x89PNG')
+    assert service.stats()['inline'] == 1
+
+def test_renderService_pool():
+    service = RenderService(1, queueSize=1, timeout=60)
+    service.start()
+
+    try:
+        data = service.render('playlist', 'energy', [{'name': 'test', 'energy': 0.5}], 'test')
+    finally:
+        service.stop()
+
+    assert data.startswith(b'\x89PNG')
+    assert service.stats()['pool'] == 1
+
+def test_renderService_timeout_leaves_job_running():
+    service = RenderService(1, queueSize=1, timeout=0)
+    service.start()
+    finished = threading.Event()
+    results = []
+
+    def done(data):
+        results.append(data)
+        finished.set()
+
+    try:
+        data = service.render('playlist', 'energy', [{'name': 'test', 'energy': 0.5}], 'test', done=done)
+        assert finished.wait(timeout=60)
+    finally:
+        service.stop()
+
+    assert data is None
+    assert results[0].startswith(b'\x89PNG')
+    assert service.stats()['timeouts'] == 1
+    assert service.stats()['inline'] == 0
+
+def test_renderService_background():
+    service = RenderService(1, queueSize=1, timeout=60)
+    finished = threading.Event()
+    results = []
+
+    def done(data):
+        results.append(data)
+        finished.set()
+
+    # Nothing is rendered without a pool
+    assert not service.background('playlist', 'energy', [{'name': 'test', 'energy': 0.5}], 'test', done=done)
+
+    service.start()
+    try:
+        assert service.background('playlist', 'energy', [{'name': 'test', 'energy': 0.5}], 'test', done=done)
+        assert finished.wait(timeout=60)
+    finally:
+        service.stop()
+
+    assert results[0].startswith(b'\x89PNG')
+    assert service.stats()['background'] == 1
+    assert service.stats()['inline'] == 0
+
+def _pngSize(data):
+    # Width and height are in the header chunk
+    return struct.unpack('>II', data[16:24])
+
+def test_plot_aggregates_large_playlists():
+    from badstats import plot
+
+    tracks = [{'name': str(i), 'energy': i % 7} for i in range(5000)]
+
+    bars = plot.bars('energy', tracks[:500], 'bars', 1000)
+    aggregated = plot.bars('energy', tracks, 'large', 1000)
+
+    assert aggregated.startswith(b'\x89PNG')
+    # The summary is the same size however many tracks there are
+    assert _pngSize(plot.bars('energy', tracks[:2000], 'large', 1000)) == _pngSize(aggregated)
+    assert _pngSize(aggregated)[1] < _pngSize(bars)[1]
+
+def test_figurePool_reuse():
+    from badstats.plot import FigurePool
+
+    pool = FigurePool(maxFigures=1, maxPixels=10 ** 6)
+
+    figure = pool.acquire((2, 2))
+    figure.subplots().bar([0, 1], [1, 2])
+    first = pool.render(figure)
+
+    # The same figure comes back blank
+    again = pool.acquire((2, 2))
+    assert again is figure
+    assert not again.axes
+
+    again.subplots().bar([0, 1], [1, 2])
+    assert pool.render(again) == first
+    assert pool.stats() == {'created': 1, 'reused': 1, 'buffers_dropped': 0}
+
+def test_figurePool_caps():
+    from badstats.plot import FigurePool
+
+    pool = FigurePool(maxFigures=1, maxPixels=100)
+
+    first, second = pool.acquire(), pool.acquire()
+    pool.render(first)
+    pool.render(second)
+
+    # Only one figure is kept, without its pixel buffer
+    assert pool.acquire() is first
+    assert pool.acquire() is not second
+    assert pool.stats()['buffers_dropped'] == 1
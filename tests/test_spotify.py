@@ -1,8 +1,20 @@
-import pytest, os
+import pytest, os, threading, time
+import numpy as np
 from datetime import datetime, timezone, timedelta
 from badstats.db import get_db
 from spotify.Spotify import UserSpotify, Spotify
-from spotify.Token import Token, UserToken, ClientToken, BasicCreds
+from spotify.Token import Token, UserToken, ClientToken, BasicCreds, UserCreds
+from spotify.Lease import Lease
+from spotify.WebAPI import SessionPool
+from spotify.Paging import Paging
+from spotify.Cache import ResponseCache
+from spotify.Features import FeatureStore
+from spotify.TrackTable import TrackTable
+from spotify.Similarity import Similarity
+from spotify.Snapshots import PlaylistSnapshots
+from spotify.AsyncSpotify import AsyncSpotify
+from spotify.WebAPI import WebAPI
+from spotify.SingleFlight import SingleFlight
 
 def test_public_spotify_init_fail(app, spotify_creds, dbReturnsNone):
     with app.app_context():
@@ -228,4 +240,475 @@ def test_UserToken_addToDB(app):
         assert dbEntry['sessionid'] == "test"
 
         db.execute('DELETE FROM token WHERE sessionid="test"')
-        db.commit()
\ No newline at end of file
+        db.commit()
+
+def test_sessionPool_shares_adapters():
+    import threading
+
+    pool = SessionPool(poolSize=2)
+    sessions = []
+
+    thread = threading.Thread(target=lambda: sessions.append(pool.session()))
+    thread.start()
+    thread.join()
+
+    assert pool.session() is pool.session()
+    assert pool.session() is not sessions[0]
+
+    api = "https://api.spotify.com"
+    assert pool.session().get_adapter(f"{api}/v1/albums") is sessions[0].get_adapter(f"{api}/v1/albums")
+    assert pool.session().get_adapter(f"{api}/v1/albums")._pool_maxsize == 2
+    assert pool.stats() == {}
+
+def test_sessionPool_invalid_size():
+    with pytest.raises(Exception):
+        SessionPool(poolSize=0)
+
+def _fakePages(total, limit):
+    """Build a paging query over range(total) like the spotify api would."""
+
+    base = "https://api.spotify.com/v1/playlists/test/tracks"
+    requested = []
+
+    def page(offset):
+        nextOffset = offset + limit
+        return {
+            'items': list(range(offset, min(nextOffset, total))),
+            'limit': limit,
+            'offset': offset,
+            'total': total,
+            'next': f"{base}?offset={nextOffset}&limit={limit}" if nextOffset < total else None,
+        }
+
+    def query(url):
+        requested.append(url)
+        return page(int(url.split("offset=")[1].split("&")[0]))
+
+    return page(0), query, requested
+
+@pytest.mark.parametrize('prefetch', (0, 1, 3))
+def test_paging_follows_next(prefetch):
+    first, query, requested = _fakePages(total=250, limit=100)
+
+    paging = Paging(query, first, prefetch=prefetch)
+
+    assert paging.total() == 250
+    assert list(paging) == list(range(250))
+    assert len(requested) == 2
+
+def test_paging_is_lazy():
+    first, query, requested = _fakePages(total=250, limit=100)
+
+    items = iter(Paging(query, first))
+
+    assert next(items) == 0
+    assert requested == []
+
+def test_paging_single_page():
+    first, query, requested = _fakePages(total=5, limit=100)
+
+    assert list(Paging(query, first, prefetch=2)) == list(range(5))
+    assert requested == []
+
+def test_multipleItems_chunks_in_order(app, fake_catalog):
+    ids = [f'{i}' for i in range(120)]
+
+    with app.app_context():
+        tracks = Spotify().multipleItems('song', ids)
+
+    assert [track['id'] for track in tracks] == ids
+    assert sorted(len(params['ids'].split(',')) for url, params in fake_catalog) == [20, 50, 50]
+
+def test_multipleSongDetails_chunks(app, fake_catalog):
+    ids = [f'{i}' for i in range(150)]
+
+    with app.app_context():
+        tracks = Spotify().multipleSongDetails(ids)
+
+    assert [track['id'] for track in tracks] == ids
+    assert all(track['energy'] == 0.5 for track in tracks)
+
+    featureRequests = [params for url, params in fake_catalog if url.endswith('audio-features')]
+    assert sorted(len(params['ids'].split(',')) for params in featureRequests) == [50, 100]
+
+def test_multipleSongDetails_null_and_duplicate_features(app, fake_catalog):
+    ids = ['a', 'missing', 'b', 'a']
+
+    with app.app_context():
+        tracks = Spotify().multipleSongDetails(ids)
+
+    assert [track['id'] for track in tracks] == ids
+    assert [track.get('energy') for track in tracks] == [0.5, None, 0.5, 0.5]
+    assert tracks[0] is not tracks[3]
+
+def _insertClientToken(db, value, expires):
+    db.execute('DELETE FROM token WHERE token_type="client"')
+    db.execute('INSERT INTO token (token, expires, refresh, token_type, sessionid)'
+            ' VALUES (?, ?, ?, ?, ?)',
+            (value, expires.isoformat(), None, "client", None)
+            )
+    db.commit()
+
+def test_BasicCreds_cached_in_memory(app):
+    with app.app_context():
+        db = get_db()
+        _insertClientToken(db, "cached", datetime.utcnow() + timedelta(hours=1))
+
+        assert BasicCreds().value() == "cached"
+
+        # Later creds don't go back to the database
+        db.execute('DELETE FROM token WHERE token_type="client"')
+        db.commit()
+
+        assert BasicCreds().value() == "cached"
+
+def test_BasicCreds_refresh_margin(app, fake_catalog):
+    app.config['CLIENT_TOKEN_REFRESH_MARGIN'] = 600
+
+    with app.app_context():
+        db = get_db()
+        _insertClientToken(db, "expiring", datetime.utcnow() + timedelta(minutes=5))
+
+        assert BasicCreds().value() == "fake_client_token"
+
+        dbRows = db.execute('SELECT * FROM token WHERE token_type="client"').fetchall()
+        assert [row['token'] for row in dbRows] == ["fake_client_token"]
+
+def test_lease_single_holder(app):
+    with app.app_context():
+        first = Lease("test")
+        second = Lease("test")
+
+        assert first.acquire()
+        assert not second.acquire()
+
+        first.release()
+        assert second.acquire()
+        second.release()
+
+def test_lease_expires(app):
+    with app.app_context():
+        assert Lease("test", duration=timedelta(seconds=-1)).acquire()
+        assert Lease("test").acquire()
+
+def test_lease_run_reuses_fresh_result(app):
+    with app.app_context():
+        def refresh():
+            raise Exception("Should not refresh when a fresh result exists")
+
+        assert Lease("test").run(lambda: "fresh", refresh) == "fresh"
+        assert Lease("test").run(lambda: None, lambda: "refreshed") == "refreshed"
+
+def test_UserCreds_refresh(app, mock_spotify_auth):
+    with app.app_context():
+        db = get_db()
+        db.execute('INSERT INTO token (token, expires, refresh, token_type, sessionid)'
+                ' VALUES (?, ?, ?, ?, ?)',
+                ("test", "2000-01-01T00:00:00", "test", "auth", "test")
+                )
+        db.commit()
+
+        creds = UserCreds("test")
+
+        assert creds.value() == "fake_auth_token"
+
+        dbRows = db.execute('SELECT * FROM token WHERE sessionid="test"').fetchall()
+        assert len(dbRows) == 1
+        assert dbRows[0]['token'] == "fake_auth_token"
+        assert dbRows[0]['refresh'] == "fake_refresh_token"
+        assert db.execute('SELECT * FROM lease').fetchone() is None
+
+class _CachedResponse:
+    def __init__(self, size):
+        self.content = b"x" * size
+
+def test_responseCache_key_normalization():
+    assert ResponseCache.key("HTTPS://API.spotify.com/v1/albums/", {'market': 'US', 'ids': 'a,b'}) \
+        == ResponseCache.key("https://api.spotify.com/v1/albums?ids=a,b", {'market': 'US'})
+    assert ResponseCache.key("https://api.spotify.com/v1/albums", {'ids': 'a,b'}) \
+        != ResponseCache.key("https://api.spotify.com/v1/albums", {'ids': 'b,a'})
+
+def test_responseCache_ttl():
+    assert ResponseCache.ttl("https://api.spotify.com/v1/artists/id/top-tracks") == 6 * 60 * 60
+    assert ResponseCache.ttl("https://api.spotify.com/v1/albums/id") == 24 * 60 * 60
+    assert ResponseCache.ttl("https://api.spotify.com/v1/me/playlists") is None
+
+def test_responseCache_lru_eviction():
+    cache = ResponseCache(maxBytes=10)
+    url = "https://api.spotify.com/v1/tracks"
+
+    cache.put("a", url, _CachedResponse(4))
+    cache.put("b", url, _CachedResponse(4))
+    assert cache.get("a") is not None
+
+    cache.put("c", url, _CachedResponse(4))
+
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
+    assert cache.stats()['evictions'] == 1
+    assert cache.stats()['bytes'] == 8
+
+def test_spotify_serves_catalog_from_cache(app, fake_catalog):
+    with app.app_context():
+        first = Spotify().multipleItems('song', ['a', 'b'])
+        first[0]['name'] = 'changed'
+
+        second = Spotify().multipleItems('song', ['a', 'b'])
+
+        assert len(fake_catalog) == 1
+        assert second[0]['name'] == 'name a'
+        assert Spotify.responseCache().stats()['hits'] == 1
+
+def test_featureStore_roundtrip(app):
+    feature = {'id': 'a', 'energy': 0.5, 'key': 3, 'tempo': 120.5, 'type': 'audio_features'}
+
+    with app.app_context():
+        store = FeatureStore()
+        store.add([feature, None])
+
+        stored = store.get(['a', 'b', 'a'])
+
+    assert list(stored) == ['a']
+    assert stored['a']['energy'] == 0.5
+    assert stored['a']['key'] == 3
+    assert stored['a']['tempo'] == 120.5
+    assert stored['a']['uri'] == 'spotify:track:a'
+
+def test_multipleSongDetails_uses_feature_store(app, fake_catalog):
+    with app.app_context():
+        FeatureStore().add([{'id': 'a', 'energy': 0.25}])
+
+        tracks = Spotify().multipleSongDetails(['a', 'b'])
+
+        featureRequests = [params for url, params in fake_catalog if url.endswith('audio-features')]
+        assert [params['ids'] for params in featureRequests] == ['b']
+        assert [track['energy'] for track in tracks] == [0.25, 0.5]
+        assert 'b' in FeatureStore().get(['b'])
+
+def test_trackTable_columns():
+    tracks = [
+        {'id': 'a', 'name': 'A', 'energy': 0.5, 'tempo': 120},
+        None,
+        {'id': 'b', 'name': 'B', 'energy': None, 'tempo': 90},
+    ]
+
+    table = TrackTable.fromTracks(tracks, ['energy', 'tempo'])
+
+    assert len(table) == 2
+    assert table.columns() == ('energy', 'tempo')
+    assert 'danceability' not in table
+    assert list(table.column('tempo')) == [120.0, 90.0]
+
+    names, values = table.present('energy')
+    assert list(names) == ['A']
+    assert list(values) == [0.5]
+
+def test_trackTable_all_features():
+    table = TrackTable.fromTracks([{'id': 'a', 'name': 'A', 'popularity': 3}])
+
+    assert table.columns() == TrackTable.features
+    assert table.column('popularity')[0] == 3
+    assert len(table.present('energy')[1]) == 0
+
+def test_trackTable_summary():
+    tracks = [
+        {'id': str(i), 'name': str(i), 'energy': i / 10, 'tempo': 100 + i, 'key': i % 3 - 1, 'mode': i % 2}
+        for i in range(11)
+    ]
+    tracks.append({'id': 'none', 'name': 'none'})
+
+    summary = TrackTable.fromTracks(tracks).summary(['energy', 'popularity'])
+
+    assert summary['tracks'] == 12
+    assert summary['features']['energy']['count'] == 11
+    assert summary['features']['energy']['mean'] == pytest.approx(0.5)
+    assert summary['features']['energy']['percentiles']['90'] == pytest.approx(0.9)
+    assert summary['features']['popularity']['mean'] is None
+    # Keys of -1 weren't detected
+    assert summary['keys']['C'] == 4 and summary['keys']['C♯/D♭'] == 3
+    assert summary['modes'] == {'major': 5, 'minor': 6}
+    assert summary['tempo'] == {'edges': [100.0, 110.0, 120.0], 'counts': [10, 1]}
+
+def _similarityTable(prefix, values):
+    return TrackTable.fromTracks([
+        dict({feature: value for feature in Similarity.features}, id=f'{prefix}{i}', name=f'{prefix}{i}')
+        for i, value in enumerate(values)
+    ])
+
+@pytest.mark.parametrize('chunkSize', (1, 2, 1024))
+def test_similarity_nearest(chunkSize):
+    a = _similarityTable('a', [0, 1, None, 5])
+    b = _similarityTable('b', [4.9, 0.1, 1.2])
+
+    indices, distances = Similarity([a, b], chunkSize=chunkSize).nearest(0, 1)
+
+    # The track without features isn't matched
+    assert indices.tolist() == [1, 2, -1, 0]
+    assert distances[0] == pytest.approx(distances[1] / 2)
+    assert np.isnan(distances[2])
+
+def test_similarity_compare():
+    a = _similarityTable('x', [0, 1, 2])
+    b = _similarityTable('x', [0, 1, 5])
+
+    comparison = Similarity([a, b]).compare(0, 1, closest=2)
+
+    assert comparison['shared'] == 3
+    assert [pair['track'] for pair in comparison['closest']] == ['x0', 'x1']
+    assert comparison['closest'][0]['distance'] == pytest.approx(0, abs=1e-6)
+    assert comparison['distributions']['energy'] > 0
+    assert Similarity([a, a]).compare(0, 1)['distribution'] == pytest.approx(0)
+
+def test_similarity_needs_two_tables():
+    with pytest.raises(Exception):
+        Similarity([_similarityTable('a', [0])])
+
+def test_playlistSnapshots(app):
+    table = TrackTable.fromTracks([{'id': 'a', 'name': 'A', 'energy': 0.5}, {'id': 'b', 'name': 'B'}])
+
+    with app.app_context():
+        snapshots = PlaylistSnapshots()
+        assert snapshots.get('playlist', 'one') is None
+
+        snapshots.put('playlist', 'one', 'Playlist', table)
+        name, stored = snapshots.get('playlist', 'one')
+
+        assert name == 'Playlist'
+        assert list(stored.ids) == ['a', 'b']
+        assert stored.column('energy')[0] == 0.5
+
+        # Only the latest version of a playlist is kept
+        snapshots.put('playlist', 'two', 'Playlist', table)
+        assert snapshots.get('playlist', 'one') is None
+        assert snapshots.get('playlist', 'two') is not None
+
+def test_asyncSpotify_albumTrackDetails(app, fake_catalog):
+    with app.app_context():
+        spotify = AsyncSpotify()
+        details = spotify.run(spotify.albumTrackDetails('test'))
+
+        assert details['album'] == 'album test'
+        assert [track['id'] for track in details['tracks']] == ['test-1', 'test-2', 'test-3']
+        assert all(track['energy'] == 0.5 for track in details['tracks'])
+
+        # The same tracks as the synchronous client gives
+        expected = Spotify().albumTrackDetails('test')
+        assert [track['name'] for track in details['tracks']] == [track['name'] for track in expected['tracks']]
+
+def test_asyncSpotify_item_concurrent(app, fake_catalog, monkeypatch):
+    get = WebAPI._pool.get
+
+    def slowGet(*args, **kwargs):
+        time.sleep(0.3)
+        return get(*args, **kwargs)
+
+    monkeypatch.setattr(WebAPI._pool, "get", slowGet)
+
+    with app.app_context():
+        spotify = AsyncSpotify()
+
+        start = time.monotonic()
+        artist = spotify.run(spotify.item('artist', 'test'))
+
+        # The artist and its top tracks are fetched at the same time
+        assert time.monotonic() - start < 0.55
+        assert artist['name'] == 'artist test'
+        assert artist['tracks'][0]['id'] == 'top'
+
+def test_asyncSpotify_uses_webapi_pool(app, fake_catalog, monkeypatch):
+    get = WebAPI._pool.get
+    threads = []
+
+    def recordingGet(*args, **kwargs):
+        threads.append(threading.current_thread().name)
+        return get(*args, **kwargs)
+
+    monkeypatch.setattr(WebAPI._pool, "get", recordingGet)
+
+    with app.app_context():
+        # The synchronous client waits on the same coroutines
+        tracks = Spotify().multipleItems('song', [str(i) for i in range(120)])
+
+    # One pool no larger than the connection pool sends every request
+    assert len(tracks) == 120
+    assert threads and all(name.startswith('spotify-webapi') for name in threads)
+
+def test_singleFlight_shares_call():
+    flight = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def call():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 'result'
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flight.do('key', call)))
+    leader.start()
+    started.wait(5)
+
+    followers = [threading.Thread(target=lambda: results.append(flight.do('key', call))) for i in range(3)]
+    for follower in followers:
+        follower.start()
+    while flight.stats()['coalesced'] < 3:
+        time.sleep(0.01)
+
+    release.set()
+    for thread in [leader, *followers]:
+        thread.join(5)
+
+    assert results == ['result'] * 4
+    assert len(calls) == 1
+    assert flight.stats() == {'calls': 1, 'coalesced': 3, 'in_flight': 0}
+
+    # Once it's done the next caller calls again
+    assert flight.do('key', lambda: 'again') == 'again'
+
+def test_singleFlight_shares_exception():
+    flight = SingleFlight()
+
+    def fail():
+        raise ValueError('failed')
+
+    with pytest.raises(ValueError):
+        flight.do('key', fail)
+
+    assert flight.stats()['in_flight'] == 0
+
+def test_spotify_coalesces_identical_requests(app, fake_catalog, monkeypatch):
+    app.config['SPOTIFY_CACHE_BYTES'] = 0
+    get = WebAPI._pool.get
+
+    def slowGet(*args, **kwargs):
+        time.sleep(0.3)
+        return get(*args, **kwargs)
+
+    monkeypatch.setattr(WebAPI._pool, "get", slowGet)
+
+    barrier = threading.Barrier(4)
+    results = []
+
+    def view():
+        with app.app_context():
+            spotify = Spotify()
+            barrier.wait(5)
+            results.append(spotify.item('album', 'test'))
+
+    threads = [threading.Thread(target=view) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(results) == 4
+    assert len([url for url, params in fake_catalog if url.endswith('/albums/test')]) == 1
+
+    # Everyone got objects of their own
+    results[0].update({'name': 'changed'})
+    assert results[1]['name'] == 'album test'
+
+    with app.app_context():
+        assert Spotify.singleFlight().stats()['coalesced'] == 3